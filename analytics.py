@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+# analytics.py - incremental cost and savings of the relay cutoffs
+
+from bisect import bisect_right
+import datetime
+import threading
+
+# Per period: seconds on, seconds off, seconds on and off with a known
+# price and the sums of price * seconds while on (paid) and off (avoided)
+FIELDS = ("on", "off", "priced_on", "priced_off", "paid", "avoided")
+
+class Savings:
+    '''
+    Integrates the relay state of one channel over time against the spot
+    prices, see SavingsByChannel for all channels of a device. The totals per day, month and year are updated on each relay
+    call and price series, so reports never rescan the history. Time
+    without a known price is kept aside and priced when the prices arrive.
+    '''
+    def __init__(self, load_kw=1.0, channel="1", with_tax=True, max_unpriced=64):
+        self.load_kw = load_kw
+        self.channel = channel
+        self.with_tax = with_tax
+        self.max_unpriced = max_unpriced
+        self.totals = {} # "2025-10-01", "2025-10" and "2025" to FIELDS values
+        self.unpriced = [] # (start, end, state) waiting for the prices
+        self.spot_prices = None
+        self.state = None
+        self.since = None
+        self.lock = threading.Lock()
+
+    def record_state(self, id, state, t):
+        if id != self.channel:
+            return
+        with self.lock:
+            self.checkpoint_locked(t)
+            self.state = state
+            self.since = t
+
+    def record_prices(self, spot_prices):
+        with self.lock:
+            self.spot_prices = spot_prices
+            unpriced = self.unpriced
+            self.unpriced = []
+            for start, end, state in unpriced:
+                # earlier slots will not appear in any later series
+                if spot_prices.start_time() is not None and end > spot_prices.start_time():
+                    self.add(start, end, state, self.totals, timed=False)
+
+    def checkpoint(self, t):
+        '''
+        Add the time since the last relay call to the totals.
+        '''
+        with self.lock:
+            self.checkpoint_locked(t)
+
+    def checkpoint_locked(self, t):
+        if self.state is not None and t > self.since:
+            self.add(self.since, t, self.state, self.totals)
+            self.since = t
+
+    def slices(self, start, end):
+        '''
+        Yields (start, end, price) split at the price slots and at local
+        midnight, price is None when not known.
+        '''
+        spot_prices = self.spot_prices
+        t = start
+        while t < end:
+            midnight = datetime.datetime.combine(datetime.date.fromtimestamp(t) + datetime.timedelta(days=1),
+                                                 datetime.time()).timestamp()
+            price = None
+            i = spot_prices.index_at(t) if spot_prices else None
+            if i is not None:
+                prices = spot_prices.prices_with_tax if self.with_tax else spot_prices.prices
+                price = prices[i]
+                boundary = spot_prices.times[i] + spot_prices.duration
+            elif spot_prices and bisect_right(spot_prices.times, t) < len(spot_prices):
+                boundary = spot_prices.times[bisect_right(spot_prices.times, t)]
+            else:
+                boundary = end
+            t_end = min(end, midnight, boundary)
+            yield t, t_end, price
+            t = t_end
+
+    def add(self, start, end, state, totals, timed=True, queue=True):
+        '''
+        Add the interval to the totals of its days, months and years. With
+        timed False only the prices of earlier unpriced time are added.
+        '''
+        on = state == "1"
+        for a, b, price in self.slices(start, end):
+            day = datetime.date.fromtimestamp(a).isoformat()
+            values = [0.0] * len(FIELDS)
+            if timed:
+                values[0 if on else 1] = b - a
+            if price is None:
+                if queue:
+                    self.unpriced.append((a, b, state))
+                    del self.unpriced[:-self.max_unpriced]
+            else:
+                values[2 if on else 3] = b - a
+                values[4 if on else 5] = price * (b - a)
+            for key in (day, day[:7], day[:4]):
+                total = totals.setdefault(key, [0.0] * len(FIELDS))
+                for i, value in enumerate(values):
+                    total[i] += value
+
+    def summary(self, values):
+        '''
+        Returns the report of FIELDS values. The savings assume the energy
+        of the cutoffs is used later at the average paid price, the avoided
+        cost assumes it is not used at all. Prices are EUR/kWh, costs EUR.
+        '''
+        on, off, priced_on, priced_off, paid, avoided = values
+        paid_price = paid / priced_on if priced_on else None
+        avoided_price = avoided / priced_off if priced_off else None
+        savings = None
+        if paid_price is not None and avoided_price is not None:
+            savings = (avoided_price - paid_price) * priced_off / 3600 * self.load_kw
+        def money(value):
+            return None if value is None else round(value, 5)
+        return {
+            "on_hours": round(on / 3600, 3),
+            "off_hours": round(off / 3600, 3),
+            "average_price_paid": money(paid_price),
+            "average_price_avoided": money(avoided_price),
+            "cost": money(paid / 3600 * self.load_kw),
+            "avoided_cost": money(avoided / 3600 * self.load_kw),
+            "savings": money(savings),
+        }
+
+    def report(self, now, period=None):
+        '''
+        Returns the day, month and year reports of now and the reports of
+        the days of the month, or only the report of the given period
+        e.g. "2025-10-01", "2025-10" or "2025". The running relay state
+        is included up to now.
+        '''
+        with self.lock:
+            running = {}
+            if self.state is not None and now > self.since:
+                self.add(self.since, now, self.state, running, queue=False)
+            def summary(key):
+                values = list(self.totals.get(key, [0.0] * len(FIELDS)))
+                for i, value in enumerate(running.get(key, ())):
+                    values[i] += value
+                return self.summary(values)
+            if period is not None:
+                return summary(period)
+            day = datetime.date.fromtimestamp(now).isoformat()
+            days = sorted(key for key in set(self.totals) | set(running)
+                          if len(key) == 10 and key[:7] == day[:7])
+            return {
+                "channel": self.channel,
+                "load_kw": self.load_kw,
+                "with_tax": self.with_tax,
+                "day": summary(day),
+                "month": summary(day[:7]),
+                "year": summary(day[:4]),
+                "days": {key: summary(key) for key in days},
+            }
+
+    def get_snapshot(self, t):
+        '''
+        Returns the totals as a json serializable dict, the running relay
+        state is added to the totals up to t first.
+        '''
+        with self.lock:
+            self.checkpoint_locked(t)
+            return {"totals": {key: list(values) for key, values in self.totals.items()},
+                    "unpriced": list(self.unpriced)}
+
+    def restore_snapshot(self, data):
+        with self.lock:
+            self.totals = {key: list(values) for key, values in data.get("totals", {}).items()}
+            self.unpriced = [tuple(interval) for interval in data.get("unpriced", [])]
+
+
+class SavingsByChannel:
+    '''
+    One Savings per control channel, created when the channel is first
+    switched. load_kw is the power switched by every relay or a dict of
+    channel id to power, channels missing from it use 1.0.
+    '''
+    def __init__(self, load_kw=1.0, with_tax=True, max_unpriced=64):
+        self.load_kw = load_kw
+        self.with_tax = with_tax
+        self.max_unpriced = max_unpriced
+        self.channels = {} # channel id -> Savings
+        self.spot_prices = None
+        self.lock = threading.Lock()
+
+    def channel(self, id):
+        with self.lock:
+            savings = self.channels.get(id)
+            if savings is None:
+                load_kw = self.load_kw.get(id, 1.0) if isinstance(self.load_kw, dict) else self.load_kw
+                savings = Savings(load_kw, id, self.with_tax, self.max_unpriced)
+                if self.spot_prices is not None:
+                    savings.record_prices(self.spot_prices)
+                self.channels[id] = savings
+            return savings
+
+    def record_state(self, id, state, t):
+        self.channel(id).record_state(id, state, t)
+
+    def record_prices(self, spot_prices):
+        with self.lock:
+            self.spot_prices = spot_prices
+            channels = list(self.channels.values())
+        for savings in channels:
+            savings.record_prices(spot_prices)
+
+    def report(self, now, period=None):
+        '''
+        Returns the Savings.report() of each channel in "channels" and the
+        sums of their costs and savings in "total", per day, month and
+        year or for the given period.
+        '''
+        with self.lock:
+            channels = sorted(self.channels.items())
+        reports = {id: savings.report(now, period) for id, savings in channels}
+        def total(summaries):
+            values = {"cost": None, "avoided_cost": None, "savings": None}
+            for summary in summaries:
+                for key in values:
+                    if summary[key] is not None:
+                        values[key] = round((values[key] or 0.0) + summary[key], 5)
+            return values
+        if period is not None:
+            return {"channels": reports, "total": total(reports.values())}
+        return {"channels": reports,
+                "total": {key: total(report[key] for report in reports.values())
+                          for key in ("day", "month", "year")}}
+
+    def get_snapshot(self, t):
+        with self.lock:
+            channels = list(self.channels.items())
+        return {"channels": {id: savings.get_snapshot(t) for id, savings in channels}}
+
+    def restore_snapshot(self, data):
+        if "totals" in data:
+            # Snapshots of the single channel version
+            data = {"channels": {"1": data}}
+        for id, channel in data.get("channels", {}).items():
+            self.channel(id).restore_snapshot(channel)
+
+
+def test():
+    import time
+    from spotprice import SpotPrices
+    now = int(time.time() / 3600) * 3600
+    spot_result = [{"DateTime": datetime.datetime.fromtimestamp(now + i * 900).astimezone().isoformat(),
+                    "PriceNoTax": 0.01 * (i % 8), "PriceWithTax": 0.0125 * (i % 8)}
+                   for i in range(96)]
+    savings = Savings(load_kw=2.0)
+    savings.record_state("1", "1", now - 1800) # no prices yet
+    savings.record_prices(SpotPrices(spot_result))
+    savings.record_state("1", "0", now + 3600)
+    savings.record_state("1", "1", now + 7200)
+    print(savings.report(now + 3 * 3600)["day"])
+    by_channel = SavingsByChannel(load_kw={"1": 2.0, "2": 0.5})
+    by_channel.record_prices(SpotPrices(spot_result))
+    by_channel.record_state("1", "1", now)
+    by_channel.record_state("2", "0", now)
+    by_channel.record_state("2", "1", now + 3600)
+    print(by_channel.report(now + 3 * 3600)["total"]["day"])
+
+if __name__ == "__main__":
+    test()
@@ -1,21 +1,26 @@
 # Mock version of automationhat
 
 class MockPower:
+    def __init__(self, name):
+        self.name = name
+
     def on(self):
-        print("Power is ON")
+        print("Power", self.name, "is ON")
 
     def off(self):
-        print("Power is OFF")
+        print("Power", self.name, "is OFF")
 
 class MockRelay:
-    def __init__(self):
-        self.on = MockPower().on
-        self.off = MockPower().off
+    def __init__(self, name):
+        self.on = MockPower(name).on
+        self.off = MockPower(name).off
 
 
 class MockRelayGroup:
     def __init__(self):
-        self.one = MockRelay()
+        self.one = MockRelay("one")
+        self.two = MockRelay("two")
+        self.three = MockRelay("three")
 
 class MockAutomationHat:
     def __init__(self):
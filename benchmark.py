@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the scheduling, rendering and HTTP hot paths.
+
+Synthetic control responses and spot price arrays are generated at 60,
+15 and 5 minute resolution over 1 to 7 days and served from a local
+stand-in server. Each benchmark reports throughput, latency percentiles
+and peak memory. Results can be saved as a baseline and later runs are
+compared against it:
+
+    python3 benchmark.py --save        # store bench_baseline.json
+    python3 benchmark.py               # compare, exit 1 on regression
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import porssari
+import pricecutter_httpserver
+from standin_server import StandInServer
+
+RESOLUTIONS = (60, 15, 5) # minutes
+DAYS = (1, 2, 7)
+
+def make_control_response(start, days, resolution, channels=1):
+    '''
+    Control response in json_version 2 format with a state change every
+    other slot of the given resolution in minutes, channel n changes state
+    every 2 * n slots.
+    '''
+    step = resolution * 60
+    start = int(start / step) * step
+    end = start + days * 86400
+    controls = []
+    for channel in range(1, channels + 1):
+        schedules = [{"timestamp": str(t), "state": "01"[(i // (2 * channel)) % 2]}
+                     for i, t in enumerate(range(start + step, end, step))]
+        controls.append({"id": str(channel), "name": "", "updated": "0", "state": "1",
+                         "schedules": schedules})
+    return {
+        "metadata": {"mac": "BENCHMARK", "channels": str(channels), "timestamp": str(start),
+                     "timestamp_offset": "10800", "valid_until": str(end)},
+        "controls": controls,
+    }
+
+def make_spot_result(start, days, resolution):
+    step = resolution * 60
+    start = int(start / 86400) * 86400
+    return [{"Rank": i,
+             "DateTime": datetime.datetime.fromtimestamp(t).astimezone().isoformat(),
+             "PriceNoTax": round(0.05 + 0.04 * ((i * 7919) % 97) / 97, 5),
+             "PriceWithTax": round(0.0627 + 0.05 * ((i * 7919) % 97) / 97, 5)}
+            for i, t in enumerate(range(start, start + days * 86400, step))]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def measure(fn, iterations, setup=None):
+    '''
+    Run fn iterations times and return the latency statistics and the
+    peak memory allocated during the runs.
+    '''
+    latencies = []
+    tracemalloc.start()
+    for i in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    total = sum(latencies)
+    return {
+        "ops_per_s": round(iterations / total, 1) if total else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 4),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 4),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+def quiet(p):
+    # No event stream subscribers in the benchmarks
+    p.notify = lambda event, data: None
+    return p
+
+def make_porssari(response, spot_result):
+    p = quiet(porssari.Porssari(device_mac="BENCHMARK", client="benchmark"))
+    p.set_response(response)
+    p.set_spot_prices(porssari.SpotPrices(spot_result), spot_result)
+    return p
+
+def bench_on_off_hours(p, iterations):
+    results = {}
+    def new_version():
+        p.set_response(p.response)
+    results["cold"] = measure(lambda: p.get_on_off_hours(), iterations, setup=new_version)
+    results["warm"] = measure(lambda: p.get_on_off_hours(), iterations)
+    return results
+
+def bench_page(p, iterations):
+    results = {}
+    results["render"] = measure(lambda: pricecutter_httpserver.render_page(p), iterations)
+    httpd = pricecutter_httpserver.start_pricecutter_httpserver(p, port=0)
+    url = f"http://127.0.0.1:{httpd.server_address[1]}/"
+    try:
+        def get():
+            with urllib.request.urlopen(url) as f:
+                f.read()
+        def invalidate():
+            # A new state version with the same content
+            p.state = p.state.replace()
+        results["http_cold"] = measure(get, iterations, setup=invalidate)
+        results["http_cached"] = measure(get, iterations)
+    finally:
+        httpd.shutdown()
+    return results
+
+def bench_display(p, iterations):
+    try:
+        from PIL import Image, ImageFont
+        import display
+    except ImportError:
+        return None
+    font = ImageFont.load_default()
+    with tempfile.NamedTemporaryFile(suffix=".jpg") as background:
+        Image.new("RGB", (160, 80)).save(background.name)
+        renderer = display.DisplayRenderer(None, p, "127.0.0.1", font, font, background=background.name)
+    results = {}
+    def new_version():
+        p.set_response(p.response)
+    results["frame_cold"] = measure(renderer.update, iterations, setup=new_version)
+    results["frame_warm"] = measure(renderer.update, iterations)
+    return results
+
+def bench_update_task(response, spot_result, iterations):
+    server = StandInServer(control=response, spot=spot_result).start()
+    p = quiet(porssari.Porssari(server=server.url + "/getcontrols.php?",
+                                spot=server.url + "/TodayAndDayForward",
+                                device_mac="BENCHMARK", client="benchmark"))
+    try:
+        return {"update_task": measure(p.update_task, iterations)}
+    finally:
+        server.close()
+
+def run(iterations, resolutions=RESOLUTIONS, days=DAYS):
+    start = time.time()
+    results = {}
+    for resolution in resolutions:
+        for d in days:
+            name = f"{resolution}min_{d}d"
+            print("Running", name, file=sys.stderr)
+            response = make_control_response(start, d, resolution)
+            spot_result = make_spot_result(start, d, resolution)
+            p = make_porssari(response, spot_result)
+            case = {}
+            case.update({"on_off_hours_" + k: v for k, v in bench_on_off_hours(p, iterations).items()})
+            case.update({"page_" + k: v for k, v in bench_page(p, iterations).items()})
+            display_results = bench_display(p, iterations)
+            if display_results:
+                case.update({"display_" + k: v for k, v in display_results.items()})
+            case.update(bench_update_task(response, spot_result, max(1, iterations // 10)))
+            results[name] = case
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns list of regressions where p50 latency grew more than tolerance.
+    '''
+    regressions = []
+    for case, benches in results.items():
+        for bench, stats in benches.items():
+            base = baseline.get(case, {}).get(bench)
+            if base and stats["p50_ms"] > base["p50_ms"] * tolerance:
+                regressions.append(f"{case}/{bench}: p50 {stats['p50_ms']}ms > baseline {base['p50_ms']}ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--save", action="store_true", help="save results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed p50 slowdown factor")
+    args = parser.parse_args()
+
+    # update_task writes porssari.json and spot.json to the current directory
+    workdir = tempfile.TemporaryDirectory()
+    baseline_path = os.path.abspath(args.baseline)
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+    try:
+        # The porssari client prints on every call, keep the result table readable
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run(args.iterations)
+    finally:
+        os.chdir(cwd)
+        workdir.cleanup()
+
+    for case, benches in results.items():
+        for bench, stats in benches.items():
+            print(f"{case:12} {bench:24} {stats['ops_per_s']:>10} ops/s  p50 {stats['p50_ms']:>9}ms"
+                  f"  p95 {stats['p95_ms']:>9}ms  p99 {stats['p99_ms']:>9}ms  peak {stats['peak_kb']:>9}kB")
+
+    if args.save:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=1)
+        print("Saved baseline to", baseline_path)
+        return 0
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
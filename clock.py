@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+# clock.py - injectable clocks for the scheduling code
+
+import time
+
+class SystemClock:
+    '''
+    The wall clock.
+    '''
+    def time(self):
+        return time.time()
+
+class VirtualClock:
+    '''
+    Clock advanced explicitly, used to replay and simulate schedules
+    faster than real time.
+    '''
+    def __init__(self, start=0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def set(self, t):
+        if t > self.now:
+            self.now = t
+
+SYSTEM_CLOCK = SystemClock()
@@ -1,3 +1,15 @@
 # Edit these configurations to match with your porssari.fi account
 device_mac = "ADD-HERE-THE-DEVICE-MAC"
 client = "ADD-CLIENT-ID"
+# Power of the load switched by the relays in kW, used to estimate the
+# savings, or per channel e.g. {"1": 2.0, "2": 0.5}
+load_kw = 1.0
+# Relay state ("1" on, "0" off) left by pricecutter_async.py when it is stopped
+shutdown_state = "1"
+# Seconds between the control polls outside the price publication window,
+# also the delay of noticing an edit on porssari.fi. 5*60 notices edits
+# sooner with 6 times the polls.
+poll_interval = 30*60
+# Clients served the /admin/ profiling endpoints: None for no one, "local"
+# for the device itself only (e.g. over an ssh tunnel) or "all"
+admin_endpoints = None
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+"""
+The display module renders the pricecutter status to the 160x80 ST7735
+display of the Automation HAT Mini. The background and the static parts
+are rendered once per schedule version and only the changing regions
+are redrawn on each frame.
+"""
+
+import datetime
+import hashlib
+import io
+import threading
+import time
+
+from PIL import Image, ImageDraw
+
+import metrics
+
+colour = (255, 181, 86)
+red = (255, 0, 0)
+green = (0, 255, 0)
+blue = (0, 0, 255)
+white = (255,255,255)
+grey = (80,80,80)
+
+# Regions redrawn on every frame
+CLOCK_BOX = (20, 12, 160, 24)
+DURATION_BOX = (20, 24, 160, 36)
+STATE_BOX = (20, 36, 160, 50)
+MARKER_BOX = (0, 67, 160, 80)
+
+class DisplayRenderer:
+    def __init__(self, disp, porssari, ipaddr, font, numbers, background="images/blank.jpg"):
+        self.disp = disp
+        self.porssari = porssari
+        self.ipaddr = ipaddr
+        self.font = font
+        self.numbers = numbers
+        self.background = Image.open(background).convert("RGB")
+        self.static = None
+        self.static_key = None
+        self.timeline_start = None
+        self.frame = None
+        self.frame_hash = None
+        self.pushed = None # (hash, size, raw RGB) of the last pushed frame
+        self.png = None # (hash, png) of the last encoded frame
+        self.png_lock = threading.Lock()
+        # counters
+        self.frames = 0
+        self.static_renders = 0
+        self.pushes = 0
+        self.render_time = 0.0
+
+    def set_ipaddr(self, ipaddr):
+        if ipaddr != self.ipaddr:
+            self.ipaddr = ipaddr
+            self.static = None
+
+    def render_static(self, state):
+        '''
+        Render background, IP-address and the timeline bars with hour ticks
+        of the given porssari state. The 10 pixel bar is split between the
+        channels.
+        '''
+        image = self.background.copy()
+        draw = ImageDraw.Draw(image)
+        # Draw the IP-address
+        draw.text((20,0), "http://" + (self.ipaddr or "-") + ":3000", font=self.font, fill=colour)
+        self.timeline_start = None
+        timelines = list(state.timelines.values())
+        height = 10 // max(1, len(timelines))
+        for row, timeline in enumerate(timelines):
+            hours = timeline.get_on_off_hours(900)
+            if len(hours) == 0:
+                continue
+            start_time = min(hours.keys())
+            self.timeline_start = start_time
+            last_printed_hour = ""
+            top = 50 + row * height
+            for t in hours:
+                hour = (t - start_time) / 3600
+                thour = datetime.datetime.fromtimestamp(t).hour
+                c = grey
+                if hours[t] == '0':
+                    c = red
+                elif hours[t] == '1':
+                    c = green
+                draw.rectangle((20 + hour*5, top, 20 + hour*5 + 4, top + height), c)
+                if row == 0 and (thour % 6) == 0 and last_printed_hour != thour:
+                    draw.text((20 + hour*5, 60), str(thour), font=self.numbers, fill=white)
+                    last_printed_hour = thour
+        self.static_renders += 1
+        return image
+
+    def restore(self, box):
+        self.frame.paste(self.static.crop(box), box)
+
+    def render(self):
+        '''
+        Render the current frame and return it.
+        '''
+        start = time.perf_counter()
+        state = self.porssari.state
+        key = state.response_version
+        if key != self.static_key or self.static is None:
+            self.static = self.render_static(state)
+            self.static_key = key
+            self.frame = self.static.copy()
+        else:
+            for box in (CLOCK_BOX, DURATION_BOX, STATE_BOX, MARKER_BOX):
+                self.restore(box)
+        draw = ImageDraw.Draw(self.frame)
+        # Draw current time
+        now = datetime.datetime.now()
+        draw.text(CLOCK_BOX[0:2], now.isoformat()[0:16], font=self.font, fill=colour)
+        # Draw time to next relay update
+        draw.text(DURATION_BOX[0:2], f"Duration: {self.porssari.get_time_to_relay_update()}", font=self.font, fill=colour)
+        # Draw info on relay current state, one label per channel
+        channels = list(state.timelines) or ['1']
+        x = STATE_BOX[0]
+        for channel in channels:
+            power = state.relays.get(channel)
+            text = "TBD"
+            state_colour = grey
+            if power == '0':
+                text = "OFF"
+                state_colour = red
+            elif power == '1':
+                text = "ON"
+                state_colour = green
+            text = "Power " + text if len(channels) == 1 else f"{channel}:{text}"
+            draw.text((x, STATE_BOX[1]), text, font=self.font, fill=state_colour)
+            x += draw.textlength(text + " ", font=self.font)
+        # Draw the marker of the current time to the timeline
+        if self.timeline_start is not None:
+            xhour = (now.timestamp() - self.timeline_start) / 3600 * 5
+            draw.line(((20 + xhour, 80), (20+ xhour, 67)), width=4,fill=blue)
+        self.frames += 1
+        render_time = time.perf_counter() - start
+        self.render_time += render_time
+        metrics.display_frame_seconds.observe(render_time)
+        return self.frame
+
+    def update(self):
+        '''
+        Render the frame and push it to the display if it changed. The
+        pushed frame is kept for get_png(), without a display (headless)
+        it is only kept.
+        '''
+        frame = self.render()
+        data = frame.tobytes()
+        frame_hash = hashlib.md5(data).digest()
+        if frame_hash != self.frame_hash:
+            self.frame_hash = frame_hash
+            if self.disp:
+                self.disp.display(frame)
+            self.pushed = (frame_hash, frame.size, data)
+            self.pushes += 1
+
+    def get_png(self):
+        '''
+        Returns the last pushed frame as png or None before the first
+        frame. The frame is encoded on request, once per frame.
+        '''
+        pushed = self.pushed
+        if pushed is None:
+            return None
+        frame_hash, size, data = pushed
+        with self.png_lock:
+            if self.png is None or self.png[0] != frame_hash:
+                png = io.BytesIO()
+                Image.frombytes("RGB", size, data).save(png, "PNG")
+                self.png = (frame_hash, png.getvalue())
+            return self.png[1]
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "static_renders": self.static_renders,
+            "pushes": self.pushes,
+            "skipped": self.frames - self.pushes,
+            "render_time": round(self.render_time, 6),
+        }
@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# fetcher.py - conditional HTTP fetching of the control and spot endpoints
+
+from collections import deque
+import json
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import socket
+import threading
+import time
+import urllib3
+
+import log
+import metrics
+
+def make_session(pool_size=2):
+    '''
+    Returns a requests session keeping the connections alive between polls.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+READ_SIZE = 16384
+
+class FetchTimeout(requests.exceptions.Timeout):
+    pass
+
+def response_socket(response):
+    '''
+    Returns the socket of a streamed response or None. http.client drops
+    the socket from the connection when the server closes it after the
+    response, then it is only reachable through the response file.
+    '''
+    raw = response.raw
+    sock = getattr(getattr(raw, "connection", None), "sock", None)
+    if sock is None:
+        fp = getattr(getattr(raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    return sock if isinstance(sock, socket.socket) else None
+
+def shutdown_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+class Endpoint:
+    '''
+    Conditional GET of a single endpoint. The ETag and Last-Modified
+    validators and the parsed payload of the last successful response are
+    kept in memory, so a 304 answer costs neither parsing nor disk I/O.
+
+    Each attempt is bounded by connect_timeout and deadline, failed
+    attempts are retried with jittered exponential backoff, so the worst
+    case latency of get() is about attempts * deadline + the backoffs.
+    '''
+    def __init__(self, name, session=None, connect_timeout=5, read_timeout=10, deadline=20,
+                 attempts=3, backoff=1.0, max_backoff=10.0):
+        self.name = name
+        self.session = session or make_session()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = time.sleep
+        self.etag = None
+        self.last_modified = None
+        self.last_request = 0 # epoch of the last successful request
+        self.payload = None # parsed json of the last 200 response
+        self.payload_bytes = 0
+        self.hits = 0 # 304 responses
+        self.misses = 0 # 200 responses
+        self.errors = 0
+        self.retries = 0
+        self.bytes_received = 0
+        self.parse_time = 0.0
+        self.attempt_log = deque(maxlen=32) # (start epoch, seconds, status or error)
+
+    def headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def retry_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def get(self, url):
+        '''
+        Fetch the url and return the HTTP status code. On 200 the new
+        payload is parsed to self.payload, on 304 the previous payload is
+        kept as is. Connection errors, timeouts, malformed payloads, 429 and
+        5xx are retried.
+        '''
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                self.retries += 1
+                self.sleep(self.retry_delay(attempt - 1))
+            last = attempt == self.attempts - 1
+            try:
+                status = self.attempt(url)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError) as e:
+                # ValueError is a truncated or malformed json payload
+                log.warning("GET", self.name, "attempt", attempt + 1, "failed:", e)
+                if last:
+                    self.errors += 1
+                    raise
+                continue
+            if status == 429 or status >= 500:
+                if not last:
+                    continue
+            if status not in (200, 304):
+                self.errors += 1
+            return status
+
+    def attempt(self, url):
+        request_time = time.time()
+        log.debug("GET " + url)
+        start = time.perf_counter()
+        result = None
+        try:
+            response = self.session.get(url, headers=self.headers(), stream=True,
+                                        timeout=(self.connect_timeout, self.read_timeout))
+            with response:
+                result = response.status_code
+                if response.status_code == 200:
+                    content = self.read(response, start)
+        except Exception as e:
+            result = type(e).__name__
+            metrics.fetch_responses.labels(self.name, 0).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.attempt_log.append((int(request_time), round(elapsed, 3), result))
+            metrics.fetch_seconds.labels(self.name).observe(elapsed)
+        metrics.fetch_responses.labels(self.name, response.status_code).inc()
+        if response.status_code == 304:
+            self.hits += 1
+            self.last_request = int(request_time)
+        elif response.status_code == 200:
+            start = time.perf_counter()
+            self.payload = json.loads(content)
+            parse_time = time.perf_counter() - start
+            self.parse_time += parse_time
+            metrics.parse_seconds.labels(self.name).observe(parse_time)
+            self.payload_bytes = len(content)
+            self.bytes_received += len(content)
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            self.misses += 1
+            self.last_request = int(request_time)
+        return response.status_code
+
+    def read(self, response, start):
+        '''
+        Read the body within the deadline, a server trickling data can not
+        exceed it. The socket timeout of each read is limited to the time
+        left, with older urllib3 without read1() a timer shuts the socket
+        down at the deadline instead.
+        '''
+        raw = response.raw
+        sock = response_socket(response)
+        if not hasattr(raw, "read1"):
+            return self.read_watched(response, start, sock)
+        chunks = []
+        try:
+            while True:
+                remaining = self.deadline - (time.perf_counter() - start)
+                if remaining <= 0:
+                    raise self.deadline_exceeded()
+                if sock is not None and sock.fileno() != -1:
+                    sock.settimeout(min(self.read_timeout, remaining))
+                # returns the data of at most one socket read
+                chunk = raw.read1(READ_SIZE, decode_content=True)
+                if chunk:
+                    chunks.append(chunk)
+                elif raw.closed:
+                    break
+        except (urllib3.exceptions.ReadTimeoutError, socket.timeout) as e:
+            if time.perf_counter() - start >= self.deadline:
+                raise self.deadline_exceeded() from e
+            raise requests.exceptions.ReadTimeout(e) from e
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ConnectionError(e) from e
+        except urllib3.exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e) from e
+        return b"".join(chunks)
+
+    def read_watched(self, response, start, sock):
+        chunks = []
+        watchdog = None
+        if sock is not None:
+            watchdog = threading.Timer(max(0, self.deadline - (time.perf_counter() - start)),
+                                       shutdown_socket, (sock,))
+            watchdog.start()
+        try:
+            for chunk in response.iter_content(READ_SIZE):
+                chunks.append(chunk)
+                if time.perf_counter() - start > self.deadline:
+                    raise self.deadline_exceeded()
+        except requests.exceptions.RequestException as e:
+            if time.perf_counter() - start >= self.deadline:
+                raise self.deadline_exceeded() from e
+            raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+        if time.perf_counter() - start >= self.deadline:
+            # shut down with a possibly truncated body
+            raise self.deadline_exceeded()
+        return b"".join(chunks)
+
+    def deadline_exceeded(self):
+        return FetchTimeout(f"{self.name} exceeded deadline of {self.deadline}s")
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "retries": self.retries,
+            "bytes_received": self.bytes_received,
+            "bytes_saved": self.hits * self.payload_bytes, # estimate
+            "parse_time": round(self.parse_time, 6),
+            "last_request": self.last_request,
+            "attempts": list(self.attempt_log),
+        }
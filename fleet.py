@@ -0,0 +1,454 @@
+#!/usr/bin/python3
+"""
+Fleet mode: one process controlling many porssari.fi devices with a
+fixed number of threads. The spot prices are fetched and parsed once for
+all devices, the control endpoints are polled by a bounded worker pool,
+the relay transitions of every device run on one shared scheduler and
+are sent to the relays by a separate pool, and one HTTP server shows all
+the devices.
+
+    python3 fleet.py fleet.json
+
+The configuration is a json file:
+
+    {
+      "client": "my-client-id",
+      "workers": 8,
+      "relay_workers": 2,
+      "port": 3000,
+      "state_dir": "fleet",
+      "devices": [
+        {"mac": "AABBCCDDEEFF", "name": "Cabin",
+         "relay_url": "http://192.168.1.20/relay/{relay}?turn={on_off}"}
+      ]
+    }
+
+relay_url is requested when a relay of the device switches, {channel},
+{relay} (channel - 1), {state} ("0"/"1"), {on_off} and {mac} are
+replaced, e.g. for Shelly relays. Without relay_url the switches are only
+printed. A failed switch is retried by polling the device again after
+RELAY_RETRY seconds, doubled per failure. Optional keys: server, spot,
+poll_interval (seconds between the control polls outside the price
+publication window, 30*60 by default), update_interval and
+"fallback": true for the local fallback schedule.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import html
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+import log
+import metrics
+import optimizer
+import persist
+import polling
+import porssari
+import pricecutter_httpserver
+from clock import SYSTEM_CLOCK
+from fetcher import Endpoint, make_session
+from pricecutter_httpserver import CachedContent, PriceCutterHttpHandler, format_event, render_state
+from scheduler import SharedScheduler
+from spotprice import SpotPrices
+
+SERVER = "https://api.porssari.fi/getcontrols.php?"
+SPOT = "https://api.spot-hinta.fi/TodayAndDayForward"
+RELAY_RETRY = 60
+
+class Fleet:
+    '''
+    Porssari devices sharing one session, one spot price fetch, one
+    scheduler thread, a pool of workers polling the control endpoints and
+    a pool switching the remote relays. The switches of a device are sent
+    one at a time in order, only the latest state of a relay is sent when
+    they queue up, so a slow poll can not delay or reorder a switch.
+    '''
+    def __init__(self, devices, client="fleet", server=SERVER, spot=SPOT, workers=8,
+                 state_dir="fleet", update_interval=5*60, poll_policy=None, fallback=False,
+                 clock=None, relay_workers=2):
+        self.client = client
+        self.server = server
+        self.spot = spot
+        self.state_dir = state_dir
+        self.update_interval = update_interval
+        self.poll_policy = poll_policy
+        self.fallback = fallback
+        self.clock = clock or SYSTEM_CLOCK
+        self.session = make_session(pool_size=workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="FleetWorker")
+        self.relay_pool = ThreadPoolExecutor(max_workers=relay_workers, thread_name_prefix="FleetRelay")
+        self.relay_lock = threading.Lock()
+        self.relay_pending = {} # mac -> {channel: state} not yet sent
+        self.relay_errors = {} # mac -> consecutive failed switches
+        self.scheduler = SharedScheduler(clock=self.clock)
+        self.spot_endpoint = Endpoint("spot", self.session)
+        self.spot_cache = persist.ChecksummedFile(os.path.join(state_dir, "spot.json"))
+        self.spot_prices = SpotPrices()
+        self.spot_errors = 0
+        self.specs = {} # mac -> device configuration
+        self.devices = {} # mac -> Porssari
+        self.due = [] # (time, mac) of the next polls, mac "" polls the spot prices
+        self.next_due = {} # mac -> time of its entry in due, other entries are stale
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.listeners = []
+        os.makedirs(state_dir, exist_ok=True)
+        for spec in devices:
+            self.add_device(spec)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["devices"],
+                   client=config.get("client", "fleet"),
+                   server=config.get("server", SERVER),
+                   spot=config.get("spot", SPOT),
+                   workers=config.get("workers", 8),
+                   relay_workers=config.get("relay_workers", 2),
+                   state_dir=config.get("state_dir", "fleet"),
+                   update_interval=config.get("update_interval", 5*60),
+                   poll_policy=polling.PollPolicy(sparse=config.get("poll_interval", 30*60)),
+                   fallback=config.get("fallback", False))
+
+    def add_device(self, spec):
+        mac = spec["mac"]
+        self.specs[mac] = spec
+        p = porssari.Porssari(server=self.server, device_mac=mac,
+                              client=spec.get("client", self.client),
+                              relay_cb=lambda id, state: self.queue_relay(mac, id, state),
+                              update_interval=self.update_interval,
+                              spot=None, # shared, see poll_spot()
+                              fallback=optimizer.FallbackSpec() if self.fallback else None,
+                              clock=self.clock,
+                              poll_policy=self.poll_policy,
+                              session=self.session,
+                              scheduler=self.scheduler,
+                              cache_path=os.path.join(self.state_dir, mac + ".json"),
+                              spot_cache_path=None) # shared, see poll_spot()
+        p.add_listener(lambda event, data: self.notify(event, dict(data, device=mac)))
+        if len(self.spot_prices):
+            p.apply_spot_prices(self.spot_prices)
+        self.devices[mac] = p
+        if self.running:
+            self.schedule(mac, self.clock.time())
+        return p
+
+    def add_listener(self, listener):
+        '''
+        Register listener(event, data) called on the events of all devices,
+        data has the device mac in "device".
+        '''
+        self.listeners.append(listener)
+
+    def notify(self, event, data):
+        for listener in self.listeners:
+            try:
+                listener(event, data)
+            except Exception as e:
+                log.error("Error in listener:", e)
+
+    def start(self):
+        spot_result = self.spot_cache.load()
+        if spot_result:
+            self.apply_spot_result(spot_result)
+        self.running = True
+        self.scheduler.start()
+        now = self.clock.time()
+        self.schedule("", now)
+        for mac in self.devices:
+            self.schedule(mac, now)
+        self.thread = threading.Thread(target=self.run, name="FleetPoller", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        self.scheduler.stop()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.relay_pool.shutdown(wait=False, cancel_futures=True)
+        for p in self.devices.values():
+            p.stop()
+        self.session.close()
+
+    def schedule(self, mac, t):
+        '''
+        Poll mac at t unless an earlier poll is already due.
+        '''
+        with self.lock:
+            if mac in self.next_due and self.next_due[mac] <= t:
+                return
+            self.next_due[mac] = t
+            heapq.heappush(self.due, (t, mac))
+            self.lock.notify_all()
+
+    def run(self):
+        with self.lock:
+            while self.running:
+                now = self.clock.time()
+                while self.due and self.due[0][0] <= now:
+                    t, mac = heapq.heappop(self.due)
+                    if self.next_due.get(mac) != t:
+                        continue # replaced by an earlier poll
+                    del self.next_due[mac]
+                    self.pool.submit(self.poll, mac)
+                wait = self.due[0][0] - now if self.due else None
+                self.lock.wait(wait)
+
+    def poll(self, mac):
+        '''
+        Poll the spot prices (mac "") or the controls of a device and
+        schedule the next poll.
+        '''
+        delay = self.update_interval
+        try:
+            if not mac:
+                delay = self.poll_spot()
+            else:
+                p = self.devices[mac]
+                p.update_task()
+                delay = p.get_poll_delay()
+        except Exception as e:
+            log.exception("Error in fleet poll", mac, e)
+        if self.running:
+            self.schedule(mac, self.clock.time() + delay)
+
+    def poll_spot(self):
+        '''
+        Fetch the spot prices once for all devices, returns the delay to
+        the next fetch.
+        '''
+        try:
+            status = self.spot_endpoint.get(self.spot)
+        except Exception as e:
+            log.warning("Spot API failed with:", e)
+            status = None
+        if status == 200:
+            self.apply_spot_result(self.spot_endpoint.payload)
+            self.spot_cache.save(self.spot_endpoint.payload)
+        elif status != 304:
+            log.warning("Spot API failed with: ", status)
+        self.spot_errors = 0 if status in (200, 304) else self.spot_errors + 1
+        if self.poll_policy is None:
+            return self.update_interval
+        spot_until = self.spot_prices.end_time()
+        return self.poll_policy.spot_delay(self.clock.time(), spot_until, self.spot_errors)
+
+    def apply_spot_result(self, spot_result):
+        start = time.perf_counter()
+        spot_prices = SpotPrices(spot_result)
+        metrics.parse_seconds.labels("spot_index").observe(time.perf_counter() - start)
+        self.spot_prices = spot_prices
+        for p in list(self.devices.values()):
+            p.apply_spot_prices(spot_prices, spot_result)
+
+    def queue_relay(self, mac, id, state):
+        '''
+        Queue a relay switch of a device, called from the scheduler thread.
+        '''
+        with self.relay_lock:
+            pending = self.relay_pending.get(mac)
+            if pending is not None:
+                # The device is being switched, its worker sends this too
+                pending[id] = state
+                return
+            self.relay_pending[mac] = {id: state}
+        self.relay_pool.submit(self.send_relays, mac)
+
+    def send_relays(self, mac):
+        '''
+        Send the queued switches of a device until none are left, run in
+        the relay pool with at most one worker per device.
+        '''
+        while True:
+            with self.relay_lock:
+                changes = self.relay_pending[mac]
+                if not changes:
+                    del self.relay_pending[mac]
+                    return
+                self.relay_pending[mac] = {}
+            for id, state in changes.items():
+                self.actuate(mac, id, state)
+
+    def actuate(self, mac, id, state):
+        '''
+        Switch the remote relay of a device. On failure the relay is
+        marked unknown in the device state, so the next poll switches it
+        to the state of the schedule, and the poll is brought forward.
+        '''
+        url = self.specs[mac].get("relay_url")
+        if not url:
+            return
+        url = url.format(mac=mac, channel=id, relay=int(id) - 1, state=state,
+                         on_off="on" if state == "1" else "off")
+        try:
+            self.session.get(url, timeout=(5, 10)).raise_for_status()
+        except requests.RequestException as e:
+            errors = self.relay_errors.get(mac, 0) + 1
+            self.relay_errors[mac] = errors
+            delay = min(RELAY_RETRY * 2 ** (errors - 1), self.update_interval)
+            log.warning("Failed to switch relay", mac, id, "to", state, ":", e,
+                        "retrying in", delay, "seconds")
+            self.devices[mac].forget_relay(id, state)
+            if self.running:
+                self.schedule(mac, self.clock.time() + delay)
+            return
+        self.relay_errors[mac] = 0
+
+    def status(self):
+        '''
+        Returns the state of all devices as json serializable dict.
+        '''
+        devices = {}
+        for mac, p in self.devices.items():
+            device = render_state(p)
+            device["name"] = self.specs[mac].get("name", "")
+            device["fetch_errors"] = p.fetch_errors
+            device["fallback"] = p.fallback_active
+            devices[mac] = device
+        return {"time": int(self.clock.time()), "devices": devices,
+                "spot_errors": self.spot_errors, "threads": threading.active_count()}
+
+    def get_timers(self):
+        '''
+        Returns the pending polls and the next relay switch of the shared
+        scheduler.
+        '''
+        with self.lock:
+            due = sorted((t, mac) for t, mac in self.due if self.next_due.get(mac) == t)
+        timers = [{"name": "poll", "device_mac": mac, "at": t} if mac else
+                  {"name": "spot", "at": t} for t, mac in due]
+        event = self.scheduler.next_event()
+        if event is not None:
+            t, (mac, id), state = event
+            timers.append({"name": "relay", "device_mac": mac, "at": t, "id": id,
+                           "state": state, "pending": self.scheduler.pending()})
+        return timers
+
+
+def render_fleet_page(fleet):
+    rows = []
+    for mac, device in fleet.status()["devices"].items():
+        relays = " ".join(f"{id}:{'ON' if state == '1' else 'OFF'}"
+                          for id, state in sorted(device["relays"].items()))
+        next_update = device["next_update"]
+        if next_update:
+            next_update = time.strftime("%H:%M", time.localtime(next_update["timestamp"])) \
+                + f" {next_update['id']}:{'ON' if next_update['state'] == '1' else 'OFF'}"
+        rows.append(f'<tr><td><a href="/devices/{html.escape(mac)}/">{html.escape(mac)}</a></td>'
+                    f'<td>{html.escape(device["name"])}</td><td>{relays}</td>'
+                    f'<td>{next_update or ""}</td><td>{device["fetch_errors"]}</td>'
+                    f'<td>{"yes" if device["fallback"] else ""}</td></tr>')
+    return f"""<html>
+<head>
+  <meta http-equiv="refresh" content="60">
+  <title>Price Cutter fleet</title>
+  <style>
+    body {{ background-color: black; color: #ffB556; }}
+    a {{ color: #ffB556; }}
+    td {{ padding: 0 8px; }}
+  </style>
+</head>
+<body>
+PriceCutter fleet {time.strftime("%Y-%m-%dT%H:%M:%S")}, {len(rows)} devices<br>
+<table>
+<tr><th>Device</th><th>Name</th><th>Relays</th><th>Next update</th><th>Fetch errors</th><th>Fallback</th></tr>
+{"".join(rows)}
+</table>
+</body>
+</html>
+"""
+
+
+class FleetHttpHandler(PriceCutterHttpHandler):
+    """The fleet status at / and /api/fleet, and the pages and the API of
+    each device under /devices/<mac>/."""
+
+    def __init__(self, fleet, events=None, admin=None):
+        self.fleet = fleet
+        self.events = events
+        self.admin = admin
+        self.handlers = {} # mac -> handler with the caches of the device
+        self.porssari = None
+        self.page = None
+        self.api = {}
+        self.assets = {}
+
+    def device_handler(self, mac):
+        handler = self.handlers.get(mac)
+        if handler is None and mac in self.fleet.devices:
+            handler = PriceCutterHttpHandler(self.fleet.devices[mac], self.events, admin=self.admin)
+            self.handlers[mac] = handler
+        return handler
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/devices/"):
+            mac, _, rest = path[len("/devices/"):].partition("/")
+            handler = self.device_handler(mac)
+            if handler is None:
+                self.send_error(404)
+                return
+            self.porssari = handler.porssari
+            self.page = handler.page
+            self.api = handler.api
+            self.assets = handler.assets
+            self.path = "/" + rest
+            super().do_GET()
+            return
+        if path == "/":
+            body = render_fleet_page(self.fleet).encode()
+            self.send_content(CachedContent(body, "text/html; charset=utf-8", gzip_min_size=512))
+            return
+        if path == "/api/fleet":
+            body = json.dumps(self.fleet.status()).encode()
+            self.send_content(CachedContent(body, "application/json", gzip_min_size=512))
+            return
+        if path in ("/metrics", "/logs", "/api/events") or path.startswith("/admin/"):
+            super().do_GET()
+            return
+        self.send_error(404)
+
+    def initial_event(self):
+        return format_event("fleet", self.fleet.status())
+
+    def get_timers(self):
+        return self.fleet.get_timers()
+
+
+def start_fleet_httpserver(fleet, port=3000, admin=None):
+    """Start the aggregated http server of the fleet, admin as with
+    start_pricecutter_httpserver()."""
+    events = pricecutter_httpserver.EventStream()
+    fleet.add_listener(events.publish)
+    httpd = pricecutter_httpserver.PriceCutterHttpServer(('', port), FleetHttpHandler(fleet, events, admin))
+    httpd.timeout = 1
+    thread = threading.Thread(target=httpd.serve_forever, name="FleetHttpServer", daemon=True)
+    thread.start()
+    return httpd
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("config", help="fleet configuration json")
+    parser.add_argument("--port", type=int, default=None)
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    fleet = Fleet.from_config(config)
+    fleet.start()
+    start_fleet_httpserver(fleet, args.port or config.get("port", 3000), config.get("admin"))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fleet.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# hat.py - the Automation HAT Mini device shared by pricecutter.py and pricecutter_async.py
+
+import socket
+import sys
+
+import analytics
+import history
+import log
+import optimizer
+import polling
+import porssari
+import snapshot
+from config import device_mac, client
+try:
+    from config import load_kw
+except ImportError:
+    load_kw = 1.0
+try:
+    from config import poll_interval
+except ImportError:
+    poll_interval = 30*60
+try:
+    from config import admin_endpoints
+except ImportError:
+    admin_endpoints = None
+try:
+    from config import shutdown_state
+except ImportError:
+    shutdown_state = "1" # relays on, the load runs as without the cutter
+
+import automationhat
+try:
+    import st7735
+except ImportError:
+    st7735 = None # headless, frames are still rendered for /display.png
+
+# porssari.fi channel id to the Automation HAT relay
+hat_relays = {"1": automationhat.relay.one,
+              "2": automationhat.relay.two,
+              "3": automationhat.relay.three}
+
+def set_relay(id, state):
+    log.info("Set relay to", id, state)
+    relay = hat_relays.get(id)
+    if relay is None:
+        log.warning("No relay for channel", id)
+    elif state == "1":
+        relay.on()
+    elif state == "0":
+        relay.off()
+
+def getip():
+    testIP = "8.8.8.8"
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect((testIP, 0))
+        ipaddr = s.getsockname()[0]
+        s.close()
+        return ipaddr
+    except OSError:
+        return None
+
+def make_porssari(relay_cb, state_path="state.json", **kwargs):
+    '''
+    Returns the Porssari of the device and the SnapshotWriter keeping its
+    state at state_path. The relays are restored from the snapshot before
+    anything slow is done. Other arguments are passed to Porssari.
+    '''
+    p = porssari.Porssari(device_mac=device_mac, client=client, relay_cb=relay_cb,
+                          history=history.History("history"),
+                          analytics=analytics.SavingsByChannel(load_kw=load_kw),
+                          fallback=optimizer.FallbackSpec(),
+                          poll_policy=polling.PollPolicy(sparse=poll_interval),
+                          **kwargs)
+    state = snapshot.load(state_path)
+    if state:
+        p.restore_snapshot(state)
+    writer = snapshot.SnapshotWriter(p, state_path)
+    p.add_listener(writer)
+    return p, writer
+
+def make_renderer(p):
+    '''
+    Returns the DisplayRenderer, headless without the st7735 display.
+    '''
+    try:
+        from PIL import ImageFont
+    except ImportError:
+        print("""This example requires PIL.
+Install with: sudo apt install python{v}-pil
+""".format(v="" if sys.version_info.major == 2 else sys.version_info.major))
+        sys.exit(1)
+    try:
+        from fonts.ttf import RobotoBlack as UserFont
+    except ImportError:
+        print("""This example requires the Roboto font.
+Install with: sudo pip{v} install fonts font-roboto
+""".format(v="" if sys.version_info.major == 2 else sys.version_info.major))
+        sys.exit(1)
+    import display
+
+    disp = None
+    if st7735:
+        # Create ST7735 LCD display class.
+        disp = st7735.ST7735(
+            port=0,
+            cs=st7735.BG_SPI_CS_FRONT,
+            dc=9,
+            backlight=25,
+            rotation=270,
+            spi_speed_hz=4000000
+        )
+
+        # Initialise display.
+        try:
+            disp.begin()
+        except OSError as e:
+            log.warning("Display not available, running headless:", e)
+            disp = None
+
+    font = ImageFont.truetype(UserFont, 12)
+    numbers = ImageFont.truetype(UserFont, 11)
+    return display.DisplayRenderer(disp, p, getip(), font, numbers)
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# history.py - append-only on-disk history of spot prices and relay states
+
+from array import array
+from bisect import bisect_left
+import datetime
+import mmap
+import os
+import threading
+import time
+
+import log
+
+class HistorySeries:
+    '''
+    Append-only time series stored column by column in daily segment
+    files, e.g. prices/2025-10-01.t (epoch) and prices/2025-10-01.price.
+    Appends are buffered and written in batches, files are never
+    rewritten. Reads memory-map the segments and return packed arrays.
+    '''
+    def __init__(self, directory, name, columns, batch_size=64, flush_interval=600):
+        self.directory = os.path.join(directory, name)
+        self.columns = [("t", "q")] + list(columns) # (name, array typecode)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flushed = time.monotonic()
+        self.last_epoch = None
+        self.repaired = set()
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.last_epoch = self.find_last_epoch()
+
+    def segment(self, epoch):
+        return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+    def path(self, segment, column):
+        return os.path.join(self.directory, segment + "." + column)
+
+    def segments(self):
+        return sorted(name[:-2] for name in os.listdir(self.directory) if name.endswith(".t"))
+
+    def find_last_epoch(self):
+        for segment in reversed(self.segments()):
+            times = self.read_column(segment, 0)
+            if times:
+                return times[-1]
+        return None
+
+    def append(self, epoch, *values):
+        '''
+        Append a record, records older than the last one are ignored.
+        '''
+        with self.lock:
+            if self.last_epoch is not None and epoch < self.last_epoch:
+                return False
+            self.last_epoch = epoch
+            self.buffer.append((epoch,) + values)
+            if len(self.buffer) >= self.batch_size or \
+               time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush_locked()
+        return True
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        self.flushed = time.monotonic()
+        if not self.buffer:
+            return
+        segments = {}
+        for record in self.buffer:
+            segments.setdefault(self.segment(record[0]), []).append(record)
+        for segment, records in segments.items():
+            self.repair(segment)
+            for i, (column, typecode) in enumerate(self.columns):
+                data = array(typecode, (record[i] for record in records))
+                with open(self.path(segment, column), "ab") as f:
+                    f.write(data.tobytes())
+        self.buffer = []
+
+    def repair(self, segment):
+        '''
+        Truncate the columns of a segment to the same length once, in case
+        a power cut happened in the middle of a batch.
+        '''
+        if segment in self.repaired:
+            return
+        self.repaired.add(segment)
+        counts = []
+        for column, typecode in self.columns:
+            try:
+                size = os.path.getsize(self.path(segment, column))
+            except OSError:
+                size = 0
+            counts.append(size // array(typecode).itemsize)
+        count = min(counts)
+        for (column, typecode), n in zip(self.columns, counts):
+            if n != count:
+                log.warning("Truncating history", self.path(segment, column), "to", count, "records")
+                with open(self.path(segment, column), "r+b") as f:
+                    f.truncate(count * array(typecode).itemsize)
+
+    def read_column(self, segment, index, start=0, end=None):
+        column, typecode = self.columns[index]
+        result = array(typecode)
+        try:
+            f = open(self.path(segment, column), "rb")
+        except OSError:
+            return result
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return result
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                n = size // result.itemsize
+                end = n if end is None else min(end, n)
+                result.frombytes(m[start*result.itemsize:end*result.itemsize])
+        return result
+
+    def bounds(self, segment, start, end):
+        '''
+        Returns the record index range [i, j) of segment within [start, end).
+        '''
+        f = open(self.path(segment, "t"), "rb")
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 8:
+                return 0, 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                times = memoryview(m)[:size - size % 8].cast("q")
+                try:
+                    return bisect_left(times, start), bisect_left(times, end)
+                finally:
+                    times.release()
+
+    def query(self, start, end):
+        '''
+        Returns dict of column name to array with the records within
+        [start, end), including the records not yet flushed.
+        '''
+        result = {column: array(typecode) for column, typecode in self.columns}
+        first = self.segment(start)
+        last = self.segment(max(start, end - 1))
+        with self.lock:
+            for segment in self.segments():
+                if segment < first or segment > last:
+                    continue
+                i, j = self.bounds(segment, start, end)
+                data = [self.read_column(segment, index, i, j) for index in range(len(self.columns))]
+                # the column files may differ in length after a power cut
+                n = min(len(values) for values in data)
+                for (column, typecode), values in zip(self.columns, data):
+                    result[column].extend(values[:n])
+            for record in self.buffer:
+                if start <= record[0] < end:
+                    for value, (column, typecode) in zip(record, self.columns):
+                        result[column].append(value)
+        return result
+
+
+class History:
+    '''
+    History of spot prices and relay states.
+    '''
+    def __init__(self, directory="history", **kwargs):
+        self.prices = HistorySeries(directory, "prices", [("price", "d")], **kwargs)
+        self.states = HistorySeries(directory, "states", [("channel", "B"), ("state", "B")], **kwargs)
+
+    def record_prices(self, spot_prices):
+        '''
+        Append the prices of a SpotPrices index not yet in the history.
+        '''
+        last = self.prices.last_epoch
+        for t, price in zip(spot_prices.times, spot_prices.prices):
+            if last is None or t > last:
+                self.prices.append(t, price)
+
+    def record_state(self, id, state, t=None):
+        if t is None:
+            t = int(time.time())
+        self.states.append(t, int(id), int(state))
+
+    def flush(self):
+        self.prices.flush()
+        self.states.flush()
+
+    def query_prices(self, start, end):
+        return self.prices.query(start, end)
+
+    def query_states(self, start, end):
+        return self.states.query(start, end)
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# log.py - leveled log kept in a bounded in-memory ring buffer
+
+from collections import deque
+import os
+import sys
+import threading
+import time
+import traceback
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+class RingLog:
+    '''
+    The latest capacity records in memory. When path is set the records
+    are appended to it in batches of flush_size records, at the latest
+    flush_interval seconds after the first unwritten record, and warnings
+    and errors at once. The file is rotated to path.1 at max_bytes, so the
+    log never grows the SD card without limit. With echo the records are
+    also printed as before.
+    '''
+    def __init__(self, capacity=1000, level=INFO, path=None, flush_size=100,
+                 flush_interval=60, max_bytes=256*1024, echo=True):
+        self.records = deque(maxlen=capacity) # (time, level, message)
+        self.level = level
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.echo = echo
+        self.pending = [] # formatted lines not yet on disk
+        self.flushed = time.monotonic()
+        self.timer = None # flushes the pending lines of a quiet log
+        self.dropped = 0 # records below the level
+        self.lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        with self.lock:
+            capacity = kwargs.pop("capacity", None)
+            if capacity is not None:
+                self.records = deque(self.records, maxlen=capacity)
+            for name, value in kwargs.items():
+                setattr(self, name, value)
+
+    def log(self, level, *args):
+        if level < self.level:
+            self.dropped += 1
+            return
+        record = (time.time(), level, " ".join(str(arg) for arg in args))
+        if self.echo:
+            print(*args)
+        with self.lock:
+            self.records.append(record)
+            if self.path:
+                self.pending.append(self.format(record))
+                if level >= WARNING or len(self.pending) >= self.flush_size or \
+                   time.monotonic() - self.flushed >= self.flush_interval:
+                    self.flush_locked()
+                elif self.timer is None:
+                    self.timer = threading.Timer(self.flush_interval, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.flushed = time.monotonic()
+        if not self.pending or not self.path:
+            return
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, "a") as f:
+                f.write("\n".join(self.pending) + "\n")
+        except OSError as e:
+            print("Failed to write log:", e, file=sys.stderr)
+        self.pending = []
+
+    def format(self, record):
+        t, level, message = record
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t)) + \
+            f" {LEVELS.get(level, level):7} {message}"
+
+    def tail(self, level=DEBUG, limit=None):
+        '''
+        Returns the latest records of at least level, oldest first.
+        '''
+        with self.lock:
+            records = [record for record in self.records if record[1] >= level]
+        if limit is not None:
+            records = records[-limit:] if limit > 0 else []
+        return records
+
+LOG = RingLog()
+
+def configure(**kwargs):
+    LOG.configure(**kwargs)
+
+def debug(*args):
+    LOG.log(DEBUG, *args)
+
+def info(*args):
+    LOG.log(INFO, *args)
+
+def warning(*args):
+    LOG.log(WARNING, *args)
+
+def error(*args):
+    LOG.log(ERROR, *args)
+
+def exception(*args):
+    '''
+    Log an error with the traceback of the exception being handled.
+    '''
+    LOG.log(ERROR, *args, "\n" + traceback.format_exc().rstrip())
+
+def flush():
+    LOG.flush()
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+"""
+The metrics module keeps counters, gauges and histograms in memory and
+renders them in the Prometheus text exposition format. Updating a
+metric is a dict lookup and an addition under a lock so the metrics can
+be left on permanently.
+"""
+
+from bisect import bisect_left
+import threading
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        '''
+        Returns the child metric of the label values.
+        '''
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def items(self):
+        with self.lock:
+            return sorted(self.children.items())
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Counter(Metric):
+    type = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in self.items():
+            yield f"{self.name}{format_labels(self.label_names, values)} {format_value(child.value)}"
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        '''
+        Evaluate the gauge with function() when the metrics are collected.
+        '''
+        self.function = function
+
+    def get(self):
+        if self.function:
+            return self.function()
+        return self.value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def samples(self):
+        for values, child in self.items():
+            yield f"{self.name}{format_labels(self.label_names, values)} {format_value(child.get())}"
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels, registry)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in self.items():
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, values, f'le="{format_value(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.label_names, values)
+            yield f"{self.name}_sum{labels} {format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+#######################################################################
+# Metrics of the pricecutter application
+
+fetch_seconds = Histogram("pricecutter_fetch_seconds",
+                          "Latency of the porssari.fi and spot-hinta.fi requests", ["endpoint"])
+fetch_responses = Counter("pricecutter_fetch_responses_total",
+                          "HTTP status codes of the fetches, 0 for connection errors", ["endpoint", "status"])
+parse_seconds = Histogram("pricecutter_parse_seconds",
+                          "Time to parse the fetched payloads", ["endpoint"])
+schedule_drift_seconds = Histogram("pricecutter_schedule_drift_seconds",
+                                   "Actual relay switch time minus the scheduled time",
+                                   buckets=(0.01, 0.1, 0.5, 1, 5, 30, 60, 300, 3600))
+relay_switches = Counter("pricecutter_relay_switches_total",
+                         "Relay switches per channel and state", ["channel", "state"])
+http_requests = Counter("pricecutter_http_requests_total",
+                        "HTTP server responses per path and status", ["path", "status"])
+page_render_seconds = Histogram("pricecutter_page_render_seconds",
+                                "Render time of the cached HTTP content", ["path"])
+display_frame_seconds = Histogram("pricecutter_display_frame_seconds",
+                                  "Render time of a display frame")
+threads = Gauge("pricecutter_threads", "Number of live threads")
+threads.set_function(threading.active_count)
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+# optimizer.py - local cheapest hours schedule used when porssari.fi is unreachable
+
+import datetime
+
+class FallbackSpec:
+    '''
+    Rules of the local schedule.
+
+    on_hours: hours per day the power is kept on, the cheapest ones
+    max_off: maximum consecutive off time in seconds
+    min_on: minimum length of an on block in seconds
+    low_price: power is always on at or below this price (EUR/kWh)
+    high_price: power is off at or above this price unless max_off
+        requires otherwise
+    '''
+    def __init__(self, on_hours=18, max_off=3*3600, min_on=3600, low_price=None, high_price=None):
+        self.on_hours = on_hours
+        self.max_off = max_off
+        self.min_on = min_on
+        self.low_price = low_price
+        self.high_price = high_price
+
+def day_ranges(times):
+    '''
+    Returns (start, end) index ranges of the slots of each local day.
+    '''
+    ranges = []
+    start = 0
+    for i in range(1, len(times) + 1):
+        if i == len(times) or \
+           datetime.date.fromtimestamp(times[i]) != datetime.date.fromtimestamp(times[start]):
+            ranges.append((start, i))
+            start = i
+    return ranges
+
+def select_states(prices, times, duration, spec):
+    '''
+    Returns list of booleans, True when the power is on in the slot.
+    '''
+    on = [False] * len(prices)
+    # N cheapest slots of each day, O(n log n) per day
+    for start, end in day_ranges(times):
+        day_slots = end - start
+        n_on = min(day_slots, round(spec.on_hours / 24 * day_slots))
+        for i in sorted(range(start, end), key=prices.__getitem__)[:n_on]:
+            on[i] = True
+    for i, price in enumerate(prices):
+        if spec.low_price is not None and price <= spec.low_price:
+            on[i] = True
+        elif spec.high_price is not None and price >= spec.high_price:
+            on[i] = False
+    limit_off_runs(on, prices, max(1, int(spec.max_off / duration)))
+    extend_short_on_blocks(on, prices, max(1, int(spec.min_on / duration)))
+    return on
+
+def extend_short_on_blocks(on, prices, min_slots):
+    '''
+    Extend the on blocks shorter than min_slots with the cheaper neighbour.
+    '''
+    n = len(on)
+    i = 0
+    while i < n:
+        if not on[i]:
+            i += 1
+            continue
+        start = i
+        while i < n and on[i]:
+            i += 1
+        end = i
+        while end - start < min_slots and (start > 0 or end < n):
+            if start == 0 or (end < n and prices[end] <= prices[start - 1]):
+                on[end] = True
+                end += 1
+            else:
+                start -= 1
+                on[start] = True
+        # merge with a following block
+        while end < n and on[end]:
+            end += 1
+        i = end
+
+def limit_off_runs(on, prices, max_slots):
+    '''
+    Turn on the cheapest slot of each window so that no off run is longer
+    than max_slots.
+    '''
+    n = len(on)
+    run = 0
+    i = 0
+    while i < n:
+        if on[i]:
+            run = 0
+        else:
+            run += 1
+            if run > max_slots:
+                window = range(i - max_slots, i + 1)
+                cheapest = min(window, key=prices.__getitem__)
+                on[cheapest] = True
+                run = i - cheapest
+        i += 1
+
+def build_response(spot_prices, spec, start, channel="1"):
+    '''
+    Build a json_version 2 style control response from the SpotPrices
+    index beginning at the slot containing start. Returns None if the
+    prices do not cover start.
+    '''
+    i = spot_prices.index_at(start)
+    if i is None:
+        return None
+    times = spot_prices.times[i:]
+    prices = spot_prices.prices[i:]
+    on = select_states(prices, times, spot_prices.duration, spec)
+    state = "1" if on[0] else "0"
+    schedules = []
+    previous = on[0]
+    for t, value in zip(times[1:], on[1:]):
+        if value != previous:
+            schedules.append({"timestamp": str(t), "state": "1" if value else "0"})
+            previous = value
+    return {
+        "metadata": {
+            "timestamp": str(int(start)),
+            "valid_until": str(spot_prices.end_time()),
+            "fallback": "1",
+        },
+        "controls": [{"id": channel, "name": "fallback", "updated": "0",
+                      "state": state, "schedules": schedules}],
+    }
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# persist.py - SD card friendly files: atomic, checksummed and written only on change
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import log
+
+def atomic_write(path, data):
+    '''
+    Write bytes atomically, a power cut leaves either the old or the new
+    file in place.
+    '''
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def dumps(data):
+    return json.dumps(data, separators=(",", ":"))
+
+class ChecksummedFile:
+    '''
+    Json file with a sha256 checksum of its content and the time it was
+    written. The file is written atomically and only when the content
+    differs from what is on disk, so polling the same data again costs no
+    writes. A truncated or corrupted file reads as missing.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.digest = None # sha256 of the content on disk, None if not known
+        self.known = False # digest read from disk or written
+        self.writes = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''
+        Returns the data or None if there is no valid file.
+        '''
+        with self.lock:
+            return self.load_locked()
+
+    def load_locked(self):
+        self.known = True
+        try:
+            with open(self.path) as f:
+                envelope = json.load(f)
+            data = envelope["data"]
+            digest = hashlib.sha256(dumps(data).encode()).hexdigest()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.debug("No valid", self.path, "loaded:", e)
+            self.digest = None
+            return None
+        if digest != envelope.get("sha256"):
+            log.warning(f"Checksum mismatch in {self.path}, ignoring it")
+            self.digest = None
+            return None
+        self.digest = digest
+        return data
+
+    def save(self, data):
+        '''
+        Write the data if it changed, returns True if the file was written.
+        '''
+        body = dumps(data)
+        digest = hashlib.sha256(body.encode()).hexdigest()
+        with self.lock:
+            if not self.known:
+                self.load_locked()
+            if digest == self.digest:
+                self.skipped += 1
+                return False
+            atomic_write(self.path, ('{"sha256":"' + digest + '","saved":' + str(int(time.time()))
+                                     + ',"data":' + body + '}').encode())
+            self.digest = digest
+            self.writes += 1
+        return True
+
+    def stats(self):
+        return {"writes": self.writes, "skipped": self.skipped}
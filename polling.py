@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# polling.py - adaptive polling interval for the porssari.fi client
+
+import datetime
+
+class PollPolicy:
+    '''
+    Decide the delay to the next poll. Polls densely while the next day
+    schedule is expected (the afternoon price publication window), after
+    a configuration change and on errors, and sparsely otherwise. The
+    schedule is never allowed to run out before a poll.
+
+    The control polls are conditional and answered with a bodyless 304
+    while nothing changed. The sparse interval of 30 minutes is also the
+    latency of noticing a configuration edit on porssari.fi outside the
+    window, the polls are dense for active seconds after an edit was
+    seen. sparse=5*60 keeps the latency of the fixed interval at six
+    times the polls. The spot prices only change when published, see
+    spot_delay().
+
+    dense: interval in the publication window and after changes
+    sparse: control interval when the schedule covers the next day
+    window: (start, end) of the publication window as local hours
+    active: seconds to keep polling densely after 'updated' changed
+    min_error: first retry delay after a failed poll, doubled per error
+    '''
+    def __init__(self, dense=5*60, sparse=30*60, window=(13.5, 16.5), active=30*60, min_error=60):
+        self.dense = dense
+        self.sparse = sparse
+        self.window = window
+        self.active = active
+        self.min_error = min_error
+
+    def delay(self, now, valid_until=None, spot_until=None, errors=0, updated_at=None):
+        '''
+        Returns seconds to the next poll.
+
+        now: current epoch
+        valid_until: end of the current schedule or None if there is none
+        spot_until: end of the known spot prices or None
+        errors: number of consecutive failed polls
+        updated_at: time when the controls 'updated' value last changed
+        '''
+        if errors > 0:
+            return min(self.dense, self.min_error * 2 ** (errors - 1))
+        if valid_until is None:
+            return self.dense
+        local = datetime.datetime.fromtimestamp(now)
+        midnight = (local + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        next_day_known = valid_until > midnight.timestamp() + 3600 and \
+            (spot_until is None or spot_until > midnight.timestamp() + 3600)
+        hour = local.hour + local.minute / 60
+        if updated_at is not None and now - updated_at < self.active:
+            delay = self.dense
+        elif not next_day_known and hour >= self.window[0]:
+            # Prices are published in the window, keep polling densely until they are
+            delay = self.dense
+        elif not next_day_known:
+            window_start = local.replace(hour=0, minute=0, second=0, microsecond=0) + \
+                datetime.timedelta(hours=self.window[0])
+            delay = max(self.dense, min(self.sparse, window_start.timestamp() - now))
+        else:
+            delay = self.sparse
+        # Poll before the schedule runs out
+        remaining = valid_until - now - self.dense
+        if remaining < delay:
+            delay = max(self.min_error, remaining)
+        return delay
+
+    def spot_delay(self, now, spot_until=None, errors=0):
+        '''
+        Returns seconds to the next spot price fetch. The prices of the
+        next day are fetched densely from the start of the publication
+        window until they are known, then not before the next window, so
+        a unit fetches the prices a few times a day.
+        '''
+        if errors > 0:
+            return min(self.dense, self.min_error * 2 ** (errors - 1))
+        if spot_until is None:
+            return self.dense
+        local = datetime.datetime.fromtimestamp(now)
+        midnight = (local + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        window_start = local.replace(hour=0, minute=0, second=0, microsecond=0) + \
+            datetime.timedelta(hours=self.window[0])
+        if spot_until > midnight.timestamp() + 3600:
+            # Next day known, refresh in the next window
+            window_start += datetime.timedelta(days=1)
+        delay = max(self.dense, window_start.timestamp() - now)
+        # Fetch before the prices run out
+        remaining = spot_until - now - self.dense
+        if remaining < delay:
+            delay = max(self.min_error, remaining)
+        return delay
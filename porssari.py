@@ -1,13 +1,107 @@
 #!/usr/bin/python3
 # porssari.py - a porssari.fi API client to support fetching and control calls
-# Note: This version supports single channel.
 
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import json
-import requests
+from types import MappingProxyType
+from clock import SYSTEM_CLOCK
+from fetcher import Endpoint, make_session
+from scheduler import RelayScheduler
+from spotprice import SpotPrices
 import threading
 import time
-import traceback
+
+import log
+import metrics
+import optimizer
+import persist
+
+class Timeline:
+    '''
+    Precomputed on/off timeline of a single control channel. Schedule
+    timestamps are parsed once per control response and lookups are done
+    with bisect over the sorted boundaries.
+    '''
+    def __init__(self, metadata, controls, version=0):
+        self.version = version
+        self.channel = controls.get('id', "1")
+        self.name = controls.get('name') or ""
+        schedules = sorted(controls.get('schedules', []), key=lambda s: int(s['timestamp']))
+        self.times = [int(schedule['timestamp']) for schedule in schedules]
+        self.states = [schedule['state'] for schedule in schedules]
+        self.start_state = controls.get('state', "0")
+        self.start_time = int(metadata.get('timestamp'))
+        self.end_time = int(metadata.get('valid_until'))
+        self.hours = {} # accuracy -> on/off states per slot
+
+    def state_at(self, t):
+        i = bisect_right(self.times, t)
+        if i == 0:
+            return self.start_state
+        return self.states[i - 1]
+
+    def events(self, channel, t):
+        '''
+        Returns the relay events [(timestamp, channel, state)] after t.
+        '''
+        i = bisect_right(self.times, t)
+        return [(self.times[j], channel, self.states[j]) for j in range(i, len(self.times))]
+
+    def get_on_off_hours(self, accuracy):
+        hours = self.hours.get(accuracy)
+        if hours is not None:
+            return hours
+        # As porssari may have the sceduled timestamp as +- 1 minute
+        # round the value to next 3 minute
+        rounded = [int((timestamp+180)/accuracy)*accuracy for timestamp in self.times]
+        hours = {}
+        i = 0
+        state = self.start_state
+        t = int(self.start_time / 3600)*3600
+        while t < self.end_time:
+            while i < len(rounded) and rounded[i] <= t:
+                state = self.states[i]
+                i += 1
+            hours[t] = state
+            t += accuracy
+        self.hours[accuracy] = hours
+        return hours
+
+class State:
+    '''
+    Immutable, versioned view of the controller state shared by the
+    fetcher, scheduler, HTTP and display threads. Writers publish a new
+    State with a single reference swap, so readers always see a matching
+    response, timeline, spot prices and relay states without locks.
+    '''
+    fields = {
+        "response": {}, # last response from server
+        "controls": {}, # control part of the response for the first channel
+        "timeline": None, # Timeline of the first channel
+        "timelines": MappingProxyType({}), # channel id -> Timeline of every channel
+        "response_version": 0, # incremented on every new control response
+        "spot_result": [],
+        "spot_prices": SpotPrices(),
+        "spot_version": 0, # incremented on every new spot price result
+        "relays": MappingProxyType({}), # mirror the state of relays
+        "relay_version": 0, # incremented on every relay call
+    }
+
+    def __init__(self, version=0, **values):
+        object.__setattr__(self, "version", version)
+        for name, default in self.fields.items():
+            object.__setattr__(self, name, values.get(name, default))
+        if not isinstance(self.relays, MappingProxyType):
+            object.__setattr__(self, "relays", MappingProxyType(dict(self.relays)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("State is immutable, use State.replace()")
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.fields}
+        values.update(changes)
+        return State(self.version + 1, **values)
 
 class Porssari:
     def __init__(self,
@@ -16,42 +110,283 @@ class Porssari:
                  client=None,
                  relay_cb=None, # usage relay_cb(relay_id, state)
                  update_interval = 5*60,
-                 spot="https://api.spot-hinta.fi/TodayAndDayForward"):
+                 spot="https://api.spot-hinta.fi/TodayAndDayForward",
+                 history=None, # optional history.History for prices and relay states
+                 analytics=None, # optional analytics.SavingsByChannel of the relay cutoffs
+                 fallback=None, # optional optimizer.FallbackSpec used when porssari.fi is unreachable
+                 clock=None, # clock.SystemClock by default, clock.VirtualClock for simulations
+                 poll_policy=None, # optional polling.PollPolicy, update_interval is used without
+                 session=None, # optional requests session shared with other devices
+                 scheduler=None, # optional scheduler.SharedScheduler shared with other devices
+                 cache_path="porssari.json", # last control response on disk, None disables
+                 spot_cache_path="spot.json", # last spot result on disk, None disables
+                 fetch_pool=None): # optional executor with 2+ workers for the parallel spot fetch
         self.server = server
         self.spot = spot
         self.device_mac = device_mac
         self.client = client
         self.relay_cb = relay_cb
+        self.history = history
+        self.analytics = analytics
+        self.clock = clock or SYSTEM_CLOCK
+        self.fallback = fallback
+        self.fallback_active = False
+        self.fallback_version = None # spot version of the fallback schedule
         self.update_interval = update_interval
-        self.relay_timer = None
-        self.relay_update_time = None
-        self.fetcher_timer = None
+        self.poll_policy = poll_policy
+        self.fetch_errors = 0 # consecutive failed control fetches
+        self.updated_at = None # time when controls 'updated' last changed
+        self.next_poll = None # time of the next fetch of the fetcher thread
+        self.spot_errors = 0 # consecutive failed spot fetches
+        self.next_spot_poll = None # time when the spot prices are fetched next, None on every poll
+        if scheduler is not None:
+            self.scheduler = scheduler.view(device_mac, self.call_relays)
+        else:
+            self.scheduler = RelayScheduler(self.call_relays, clock=self.clock)
+        self.control_cache = persist.ChecksummedFile(cache_path) if cache_path else None
+        self.spot_cache = persist.ChecksummedFile(spot_cache_path) if spot_cache_path else None
+        self.fetcher_thread = None
+        self.stopped = threading.Event()
         self.first = True
-        self.response = {} # last response from server
-        self.relays = {} # mirror the state of relays
-        self.controls = {} # Last control part response from server for the first element
-        self.controls_updated = 0
-        self.spot_result = []
+        self.state = State() # replaced as whole, never modified
+        self.state_lock = threading.Lock() # serializes the writers only
+        self.controls_updated = {} # channel id -> controls 'updated'
+        self.scheduled_version = None # response version of the scheduled events
+        self.listeners = [] # usage listener(event, data)
+        self.own_session = session is None
+        self.session = session or make_session()
+        self.control_endpoint = Endpoint("control", self.session)
+        self.spot_endpoint = Endpoint("spot", self.session)
+        self.own_fetch_pool = fetch_pool is None
+        self.fetch_pool = fetch_pool
+        if spot and fetch_pool is None:
+            # The spot prices are fetched in parallel with the controls
+            self.fetch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PorssariFetch")
+
+    # Read-only shortcuts to the current state
+    response = property(lambda self: self.state.response)
+    controls = property(lambda self: self.state.controls)
+    timeline = property(lambda self: self.state.timeline)
+    timelines = property(lambda self: self.state.timelines)
+    response_version = property(lambda self: self.state.response_version)
+    spot_result = property(lambda self: self.state.spot_result)
+    spot_prices = property(lambda self: self.state.spot_prices)
+    spot_version = property(lambda self: self.state.spot_version)
+    relays = property(lambda self: self.state.relays)
+    relay_version = property(lambda self: self.state.relay_version)
+
+    def set_response(self, response):
+        '''
+        Publish a new control response together with the timelines of all
+        its channels.
+        '''
+        channels = [controls for controls in response.get('controls') or [] if controls]
+        metadata = response.get('metadata', {})
+        with self.state_lock:
+            version = self.state.response_version + 1
+            timelines = {}
+            for controls in channels:
+                timeline = Timeline(metadata, controls, version)
+                timelines[timeline.channel] = timeline
+            state = self.state.replace(response=response,
+                                       controls=channels[0] if channels else {},
+                                       timeline=next(iter(timelines.values()), None),
+                                       timelines=MappingProxyType(timelines),
+                                       response_version=version)
+            self.state = state
+        return state
+
+    def set_spot_prices(self, spot_prices, spot_result=None):
+        with self.state_lock:
+            state = self.state.replace(spot_prices=spot_prices,
+                                       spot_result=spot_result if spot_result is not None else [],
+                                       spot_version=self.state.spot_version + 1)
+            self.state = state
+        return state
 
     def start(self):
+        '''
+        Start the scheduler and the fetcher thread. The first fetch is done
+        in the background, use restore_snapshot() before start() to set the
+        relays without waiting for the network.
+        '''
+        self.load_spot_cache()
+        self.scheduler.start()
+        self.fetcher_thread = threading.Thread(target=self.fetch_loop, name="PorssariFetcher", daemon=True)
+        self.fetcher_thread.start()
+
+    def load_spot_cache(self):
+        '''
+        This method applies the last spot result on disk if no prices are known.
+        '''
+        if not len(self.spot_prices) and self.spot_cache:
+            spot_result = self.spot_cache.load()
+            if spot_result:
+                self.apply_spot_result(spot_result)
+
+    def stop(self):
+        self.stopped.set()
+        self.scheduler.stop()
+        if self.fetch_pool and self.own_fetch_pool:
+            self.fetch_pool.shutdown(wait=False)
+        if self.own_session:
+            self.session.close()
+        if self.history:
+            self.history.flush()
+
+    def fetch_loop(self):
         self.update_task()
-        self.fetcher_timer = threading.Timer(self.update_interval, self.update_task)
-        self.fetcher_timer.start()
+        while True:
+            delay = self.get_poll_delay()
+            self.next_poll = self.clock.time() + delay
+            if self.stopped.wait(delay):
+                break
+            self.update_task()
+
+    def get_poll_delay(self):
+        '''
+        This method returns the seconds to wait before the next poll.
+        '''
+        if self.poll_policy is None:
+            return self.update_interval
+        timeline = self.get_timeline()
+        spot_until = self.spot_prices.end_time()
+        delay = self.poll_policy.delay(self.clock.time(),
+                                       timeline.end_time if timeline else None,
+                                       spot_until,
+                                       self.fetch_errors,
+                                       self.updated_at)
+        if self.spot and self.next_spot_poll is not None:
+            delay = min(delay, max(0, self.next_spot_poll - self.clock.time()))
+        log.debug("Next poll in", int(delay), "seconds")
+        return delay
+
+    def get_snapshot(self):
+        '''
+        This method returns the state needed to restore the relays after a
+        restart as a json serializable dict.
+        '''
+        state = self.state
+        now = int(self.clock.time())
+        return {
+            "response": state.response,
+            "controls_updated": self.controls_updated,
+            "relays": dict(state.relays),
+            "spot": state.spot_prices.to_series(),
+            "fallback_active": self.fallback_active,
+            "control_endpoint": {"etag": self.control_endpoint.etag,
+                                 "last_modified": self.control_endpoint.last_modified,
+                                 "last_request": self.control_endpoint.last_request},
+            "analytics": self.analytics.get_snapshot(now) if self.analytics else None,
+        }
+
+    def restore_snapshot(self, data):
+        '''
+        Restore the state saved by get_snapshot() and set the relays to the
+        state of the restored schedule at the current time.
+        '''
+        if self.analytics and data.get("analytics"):
+            self.analytics.restore_snapshot(data["analytics"])
+        spot = data.get("spot")
+        if spot and spot.get("times"):
+            spot_prices = SpotPrices.from_series(spot)
+            self.set_spot_prices(spot_prices)
+            if self.analytics:
+                self.analytics.record_prices(spot_prices)
+        response = data.get("response")
+        if response:
+            controls_updated = data.get("controls_updated", {})
+            if not isinstance(controls_updated, dict):
+                # Snapshots of the single channel version
+                controls_updated = {response['controls'][0]['id']: controls_updated}
+            self.controls_updated = {id: int(updated) for id, updated in controls_updated.items()}
+            self.fallback_active = data.get("fallback_active", False)
+            if not self.fallback_active:
+                endpoint = data.get("control_endpoint", {})
+                self.control_endpoint.etag = endpoint.get("etag")
+                self.control_endpoint.last_modified = endpoint.get("last_modified")
+                self.control_endpoint.last_request = endpoint.get("last_request", 0)
+                self.control_endpoint.payload = response
+            # The state of an old response is outdated, use the timeline
+            self.first = False
+            self.apply_response(response)
+            self.check_fallback()
+        elif data.get("relays"):
+            self.scheduler.replace([], list(data["relays"].items()))
 
     def call_relay(self, id, state):
-        print("RELAY ", id, "TO", state)
-        old = self.relays.get(id)
-        self.relays[id] = state
-        if self.relay_cb:
-            self.relay_cb(id, state)
+        self.call_relays([(id, state)])
+
+    def call_relays(self, changes):
+        '''
+        Switch the relays [(id, state)] as one batch: the relays are
+        switched back to back and the new states are published as one
+        state version and one "relay" event.
+        '''
+        for id, state in changes:
+            log.info("RELAY ", id, "TO", state)
+        with self.state_lock:
+            relays = dict(self.state.relays)
+            relays.update(changes)
+            self.state = self.state.replace(relays=relays,
+                                            relay_version=self.state.relay_version + 1)
+        now = self.clock.time()
+        for id, state in changes:
+            metrics.relay_switches.labels(id, state).inc()
+            if self.relay_cb:
+                self.relay_cb(id, state)
+        for id, state in changes:
+            if self.history:
+                self.history.record_state(id, state, int(now))
+            if self.analytics:
+                self.analytics.record_state(id, state, now)
+        self.notify("relay", {"relays": dict(changes), "time": int(now)})
+
+    def forget_relay(self, id, state):
+        '''
+        Mark the relay unknown after switching it to state failed, e.g. a
+        remote relay of a fleet. The next apply_response() switches it to
+        the state of the timeline. Nothing is done if the relay has been
+        switched again in the meantime.
+        '''
+        with self.state_lock:
+            if self.state.relays.get(id) != state:
+                return
+            relays = dict(self.state.relays)
+            del relays[id]
+            self.state = self.state.replace(relays=relays,
+                                            relay_version=self.state.relay_version + 1)
+
+    def add_listener(self, listener):
+        '''
+        Register listener(event, data) called on "relay", "schedule" and
+        "prices" events. Listeners are called from the fetcher and
+        scheduler threads and must not block.
+        '''
+        self.listeners.append(listener)
+
+    def notify(self, event, data):
+        for listener in self.listeners:
+            try:
+                listener(event, data)
+            except Exception as e:
+                log.error("Error in listener:", e)
 
     def get_state(self, id):
         return self.relays.get(id)
 
+    def get_next_relay_update(self):
+        '''
+        This method returns the next scheduled (timestamp, relay id, state)
+        or None.
+        '''
+        return self.scheduler.next_event()
+
     def get_time_to_relay_update(self):
-        if self.relay_update_time:
-            now = int(time.time())
-            delta = self.relay_update_time - now
+        event = self.scheduler.next_event()
+        if event:
+            now = int(self.clock.time())
+            delta = event[0] - now
             minutes = int(delta/60)%60
             hours = int(delta/3600)
             if hours > 0:
@@ -59,6 +394,14 @@ class Porssari:
             return f"{minutes}m"
         return ""
 
+    def get_version(self):
+        '''
+        This method returns the version of the current state which changes
+        whenever the control response, the spot prices or the relay states
+        change.
+        '''
+        return self.state.version
+
     def get_spot_price(self):
         '''
         This method returns the spot prices in an array of dict for
@@ -66,135 +409,257 @@ class Porssari:
         '''
         return self.spot_result;
 
-    def get_on_off_hours(self, accuracy=900):
+    def get_spot_prices(self):
+        '''
+        This method returns the spot prices as SpotPrices index parsed
+        once per fetch.
+        '''
+        return self.spot_prices
+
+    def get_timeline(self, channel=None):
+        '''
+        This method returns the Timeline of the given or the first channel
+        of the latest control response. The timelines are built once when
+        the response is published.
+        '''
+        if channel is None:
+            return self.state.timeline
+        return self.state.timelines.get(channel)
+
+    def get_timelines(self):
+        '''
+        This method returns the Timelines of all channels by channel id.
+        '''
+        return self.state.timelines
+
+    def get_on_off_hours(self, accuracy=900, channel=None):
         '''
         This method returns array of on/off state per hour in 15 minute segments starting
         from the latest start time of the control response.
         This method can be used to simplify GUI creation to display next 24h
-        states.
+        states. The returned dict is cached and must not be modified.
         '''
-        if not self.response:
+        timeline = self.get_timeline(channel)
+        if timeline is None:
             return {}
-        metadata = self.response.get('metadata', {})
-        schedules = self.controls['schedules']
-        now = time.time()
-        start_time = int(metadata.get('timestamp'))
-        start_state = self.controls.get('state', "0")
-        end_time = int(metadata.get('valid_until'))
-        t = int(start_time / 3600)*3600
-        hours = {}
-        while t < end_time:
-            state = start_state
-            for schedule in schedules:
-                schedule_timestamp = int(schedule['timestamp'])
-                # As porssari may have the sceduled timestamp as +- 1 minute
-                # round the value to next 3 minute
-                if int((schedule_timestamp+180)/accuracy)*accuracy > t:
-                    break
-                state = schedule['state']
-            hours[t] = state
-            t += accuracy
-        return hours
+        return timeline.get_on_off_hours(accuracy)
+
+    def get_savings(self, period=None):
+        '''
+        This method returns the savings report of the analytics or None
+        when the analytics are not enabled.
+        '''
+        if self.analytics is None:
+            return None
+        return self.analytics.report(self.clock.time(), period)
+
+    def get_switch_history(self):
+        '''
+        This method returns the recent relay switches as list of
+        (scheduled time, actual time, relay id, state).
+        '''
+        return list(self.scheduler.history)
+
+    def get_fetch_stats(self):
+        '''
+        This method returns the conditional fetch hit/miss counters per endpoint.
+        '''
+        return {
+            "control": self.control_endpoint.stats(),
+            "spot": self.spot_endpoint.stats(),
+        }
+
+    def get_timers(self):
+        '''
+        This method returns the pending timers: the next fetch and the next
+        relay switch with the number of switches scheduled.
+        '''
+        timers = []
+        if self.next_poll is not None:
+            timers.append({"name": "poll", "device_mac": self.device_mac, "at": self.next_poll})
+        event = self.scheduler.next_event()
+        if event is not None:
+            t, id, state = event
+            timers.append({"name": "relay", "device_mac": self.device_mac, "at": t,
+                           "id": id, "state": state, "pending": self.scheduler.pending()})
+        return timers
 
-    def relay_update_task(self, id, schedule):
-        try:
-            self.call_relay(id, schedule['state'])
-            # check the next schedule and assign a timer for it
-            schedules = self.controls.get('schedules', [])
-            now = int(time.time())
-            # check which schedule to use next
-            for schedule in schedules:
-                if int(schedule['timestamp']) > now + 30:
-                    relay_update_time = int(schedule['timestamp'])
-                    delta = relay_update_time - now
-                    print("Scheduled relay update to happen in delta: ", delta, " for state:", schedule['state'])
-                    self.relay_timer = threading.Timer(delta, self.relay_update_task, args=[id, schedule])
-                    self.relay_timer.start()
-                    self.relay_update_time = relay_update_time
-                    return
-            print("Note: Did not find next schedule, forcing main update loop to set it up when available")
-            self.first = True
-        except Exception as e:
-            print("Error in relay update:", e)
-            
     def update_task(self):
+        # Fetch the spot prices in the background while fetching the controls,
+        # the endpoints bound the time used per attempt and the number of retries.
+        # Without a spot url the prices are given with apply_spot_prices().
+        url = self.server + "device_mac=" + self.device_mac \
+            + "&" + f"last_request={self.control_endpoint.last_request}" + "&" \
+            + "client=" + self.client + "&" \
+            + "json_version=2"
+        spot_future = None
+        if self.spot and (self.next_spot_poll is None or self.clock.time() >= self.next_spot_poll):
+            spot_future = self.fetch_pool.submit(self.spot_endpoint.get, self.spot)
         try:
-            print("GET " + self.spot)
-            spot_result = requests.get(self.spot)
-            if spot_result.status_code == 200:
-                self.spot_result = spot_result.json()
-            else:
-                print("Spot API failed with: ", spot_result.status_code)
+            status, error = self.control_endpoint.get(url), None
         except Exception as e:
-            print("Spot API failed with:", e)
+            status, error = None, e
+        if spot_future is not None:
+            spot_status = None
+            try:
+                spot_status = spot_future.result()
+                if spot_status == 200:
+                    self.apply_spot_result(self.spot_endpoint.payload)
+                    if self.spot_cache:
+                        self.spot_cache.save(self.spot_endpoint.payload)
+                elif spot_status != 304:
+                    log.warning("Spot API failed with: ", spot_status)
+            except Exception as e:
+                log.warning("Spot API failed with:", e)
+            self.spot_errors = 0 if spot_status in (200, 304) else self.spot_errors + 1
+            if self.poll_policy is not None:
+                now = self.clock.time()
+                self.next_spot_poll = now + self.poll_policy.spot_delay(
+                    now, self.spot_prices.end_time(), self.spot_errors)
+        controls_ok = False
         try:
-            url = self.server + "device_mac=" + self.device_mac \
-                + "&" + "last_request=0" + "&" \
-                + "client=" + self.client + "&" \
-                + "json_version=2"
-            print("GET " + url)
-            response = requests.get(url)
-            if response.status_code != 200 and response.status_code != 304:
-                print("Failed to call control server, response: ", response)
+            if error is not None:
+                raise error
+            if status != 200 and status != 304:
+                log.warning("Failed to call control server, response: ", status)
             else:
-                if response.status_code == 304:
-                    print("Server response 304, using cached result")
-                    with open("porssari.json") as f:
-                        response = json.load(f)
-                else:
-                    response = response.json()
-                    with open("porssari.json", "w") as f:
-                        json.dump(response, f)
+                response = self.control_endpoint.payload
+                if status == 304:
+                    log.debug("Server response 304, using cached result")
+                    if response is None and self.control_cache:
+                        # Restarted with only the validators known, fall back to disk
+                        response = self.control_cache.load()
+                    if response is None:
+                        raise ValueError("304 without a cached control response")
+                    self.control_endpoint.payload = response
+                elif self.control_cache:
+                    # Written only when the response changed
+                    self.control_cache.save(response)
                 #print("#DEBUG: response", response)
-                self.response = response
-                controls = response.get('controls')[0]
-                if not controls:
-                    print("Error: Failed to get controls from control server")
-                else:
-                    # Parse the controls and prepare for next update
-                    self.controls = controls
-                    controls_updated = int(controls.get('updated'))
-                    if controls_updated > 0:
-                        # If configuration was updated reset the timer
-                        if self.controls_updated != controls_updated:
-                            self.controls_updated = controls_updated
-                            if self.relay_timer:
-                                self.relay_timer.cancel()
-                                self.relay_update_time = None
-                            self.first = True
-                    if self.first:
-                        # If this is called first time or we have schedules,
-                        # then schedule next relay update
-                        self.call_relay(controls['id'], controls['state'])
-                        schedules = controls['schedules']
-                        if len(schedules) > 0: # Note that schedules may empty if next day data is not yet available
-                            schedule = controls['schedules'][0]
-                            now = int(time.time())
-                            self.relay_update_time = int(schedule['timestamp'])
-                            delta = self.relay_update_time - now
-                            print("Scheduled relay update to happen in delta: ", delta, " for state:", schedule['state'])
-                            self.relay_timer = threading.Timer(delta, self.relay_update_task, args=[controls['id'], schedule])
-                            self.relay_timer.start()
-                            self.first = False                            
-                    else:
-                        # Check that we have changed the relay to correct state and if not then cancel the thread and force the relay
-                        # to correct state
-                        state = controls['state']
-                        old_state = self.relays.get(controls['id'])
-                        if old_state != state:
-                            print("Warning: relay state was not updated or new relay was added, forcing update")
-                            if self.relay_timer:
-                                self.relay_timer.cancel()
-                                self.relay_update_time = None
-                            self.call_relay(controls['id'], state)
-                
-
+                if self.fallback_active:
+                    log.info("Control server is back, leaving the local fallback schedule")
+                    self.fallback_active = False
+                    self.first = True
+                self.apply_response(response)
+                controls_ok = True
         except Exception as e:
-            print("Error in update: ", e)
-            print(traceback.format_exc())
-        if self.fetcher_timer != None:
-            self.fetcher_timer = threading.Timer(self.update_interval, self.update_task)
-            self.fetcher_timer.start()
+            log.exception("Error in update: ", e)
+        self.fetch_errors = 0 if controls_ok else self.fetch_errors + 1
+        if not controls_ok:
+            try:
+                self.check_fallback()
+            except Exception as e:
+                log.exception("Error in fallback schedule: ", e)
+        log.debug("Fetch stats:", self.get_fetch_stats())
+
+    def apply_spot_result(self, spot_result):
+        '''
+        Take a spot-hinta.fi result into use.
+        '''
+        start = time.perf_counter()
+        spot_prices = SpotPrices(spot_result)
+        metrics.parse_seconds.labels("spot_index").observe(time.perf_counter() - start)
+        self.apply_spot_prices(spot_prices, spot_result)
+
+    def apply_spot_prices(self, spot_prices, spot_result=None):
+        '''
+        Take a parsed SpotPrices index into use, e.g. shared by the devices
+        of a fleet.
+        '''
+        state = self.set_spot_prices(spot_prices, spot_result)
+        if self.history:
+            self.history.record_prices(spot_prices)
+        if self.analytics:
+            self.analytics.record_prices(spot_prices)
+        self.notify("prices", {"version": state.spot_version,
+                               "start": spot_prices.start_time(),
+                               "end": spot_prices.end_time()})
+
+    def check_fallback(self):
+        '''
+        Switch to a schedule computed locally from the spot prices when the
+        control server is unreachable and the last schedule has run out.
+        '''
+        if self.fallback is None:
+            return
+        now = int(self.clock.time())
+        if self.fallback_active:
+            # Recompute only when the prices changed or the schedule ran out
+            if self.fallback_version == self.spot_version and now < self.get_timeline().end_time:
+                return
+        else:
+            timeline = self.get_timeline()
+            if timeline is not None and now < timeline.end_time:
+                return
+        channels = list(self.timelines) or ["1"]
+        response = optimizer.build_response(self.spot_prices, self.fallback, now, channels[0])
+        if response is None:
+            log.warning("No spot prices available for the local fallback schedule")
+            return
+        # The same cheapest hours for every channel
+        controls = response['controls'][0]
+        response['controls'] += [dict(controls, id=channel) for channel in channels[1:]]
+        log.warning("Control server unreachable, using local fallback schedule")
+        if not self.fallback_active:
+            self.first = True
+        self.fallback_active = True
+        self.fallback_version = self.spot_version
+        self.apply_response(response)
+
+    def apply_response(self, response):
+        '''
+        Take a control response into use and schedule the relay updates of
+        all its channels.
+        '''
+        if not [controls for controls in response.get('controls') or [] if controls]:
+            log.error("Failed to get controls from control server")
+            return
+        # Parse the controls and prepare for next update
+        if response is not self.response:
+            self.set_response(response)
+        state = self.state
+        now = int(self.clock.time())
+        current = []
+        events = []
+        for channel, timeline in state.timelines.items():
+            controls = next(controls for controls in response['controls']
+                            if controls and controls.get('id', "1") == channel)
+            force = self.first
+            controls_updated = int(controls.get('updated', 0))
+            if controls_updated > 0:
+                # If configuration was updated force the relay to the new state
+                if self.controls_updated.get(channel) != controls_updated:
+                    if self.controls_updated.get(channel):
+                        self.updated_at = self.clock.time()
+                    self.controls_updated[channel] = controls_updated
+                    force = True
+            if force:
+                # If this is called first time or the configuration was updated,
+                # then set the relay to the state given by the server
+                current.append((channel, controls['state']))
+            else:
+                # Check that we have changed the relay to correct state and if not then force the relay
+                # to correct state. The state is taken from the timeline as a cached response may be old.
+                relay_state = timeline.state_at(now)
+                if state.relays.get(channel) != relay_state:
+                    log.warning("Relay", channel, "state was not updated or new relay was added, forcing update")
+                    current.append((channel, relay_state))
+            # Note that schedules may empty if next day data is not yet available
+            events.extend(timeline.events(channel, now))
+        self.first = False
+        version = state.response_version
+        if current or version != self.scheduled_version:
+            events.sort()
+            if events:
+                log.info("Scheduled", len(events), "relay updates, next in delta: ", events[0][0] - now,
+                      " for relay:", events[0][1], "state:", events[0][2])
+            self.scheduler.replace(events, current)
+            if self.scheduled_version != version:
+                self.notify("schedule", {"version": version,
+                                         "valid_until": state.timeline.end_time,
+                                         "channels": list(state.timelines),
+                                         "next": events[0] if events else None})
+            self.scheduled_version = version
 
 def test():
     relays = {}
@@ -203,9 +668,7 @@ def test():
         relays[relay_id] = state
 
     p = Porssari()
-    p.response = {"metadata":{"mac":"ABCDEDFGHIJKLMNOPQRSTUFV","channels":"1","fetch_url":"https://api.porssari.fi/getcontrols.php","timestamp":"1717947639","timestamp_offset":"10800","valid_until":"1718052900"},"controls":[{"id":"1","name":"","updated":"0","state":"1","schedules":[{"timestamp":"1717959631","state":"0"},{"timestamp":"1717966803","state":"1"},{"timestamp":"1717995541","state":"0"},{"timestamp":"1718006442","state":"1"},{"timestamp":"1718010026","state":"0"},{"timestamp":"1718013528","state":"1"}]}]}
-    p.controls = {"id":"1","name":"","updated":"0","state":"1"}
-    p.schedules = [{"timestamp":"1717959631","state":"0"},{"timestamp":"1717966803","state":"1"},{"timestamp":"1717995541","state":"0"},{"timestamp":"1718006442","state":"1"},{"timestamp":"1718010026","state":"0"},{"timestamp":"1718013528","state":"1"}]
+    p.set_response({"metadata":{"mac":"ABCDEDFGHIJKLMNOPQRSTUFV","channels":"1","fetch_url":"https://api.porssari.fi/getcontrols.php","timestamp":"1717947639","timestamp_offset":"10800","valid_until":"1718052900"},"controls":[{"id":"1","name":"","updated":"0","state":"1","schedules":[{"timestamp":"1717959631","state":"0"},{"timestamp":"1717966803","state":"1"},{"timestamp":"1717995541","state":"0"},{"timestamp":"1718006442","state":"1"},{"timestamp":"1718010026","state":"0"},{"timestamp":"1718013528","state":"1"}]}]})
     h = p.get_on_off_hours()
     print(h)
             
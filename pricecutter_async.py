@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""pricecutter_async.py - pricecutter.py on one asyncio event loop
+
+The fetcher, the relay scheduler, the display and the web server run as
+tasks of one event loop instead of threads of their own. The blocking
+parts run in small executors of their own: the http fetches, the relay
+switches, the display rendering and SPI push, and the web server
+handlers, so a slow fetch, frame or request can not delay a relay
+switch. SIGTERM and SIGINT stop the tasks, save the state and leave the
+relays in the state configured as shutdown_state.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import signal
+import threading
+
+import hat
+import log
+import pricecutter_httpserver
+import profiling
+from scheduler import AsyncScheduler
+
+DISPLAY_INTERVAL = 10.0
+HTTP_WORKERS = 4 # a slow client or /admin/profile occupies one
+
+# Set on shutdown, a fetch still running can not switch the relays after it
+relays_frozen = threading.Event()
+
+def relay_function(id, state):
+    if relays_frozen.is_set():
+        log.info("Ignoring relay", id, state, "while shutting down")
+        return
+    hat.set_relay(id, state)
+
+async def fetch_loop(p, executor):
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(executor, p.update_task)
+        delay = p.get_poll_delay()
+        p.next_poll = p.clock.time() + delay
+        await asyncio.sleep(delay)
+
+async def display_loop(renderer, executor):
+    loop = asyncio.get_running_loop()
+    while True:
+        if renderer.ipaddr is None:
+            # No network yet, try again on every update
+            renderer.set_ipaddr(await loop.run_in_executor(executor, hat.getip))
+        try:
+            await loop.run_in_executor(executor, renderer.update)
+        except Exception as e:
+            log.exception("Error in display update:", e)
+        await asyncio.sleep(DISPLAY_INTERVAL)
+
+async def main(port=3000, state_path="state.json"):
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    # The control fetch waits for the parallel spot fetch, two workers
+    fetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="PriceCutterFetch")
+    relay_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PriceCutterRelay")
+    # Display updates and anything else run in the default executor
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PriceCutter")
+    http_executor = ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="PriceCutterHttp")
+    loop.set_default_executor(executor)
+
+    # Restore the relay state from the snapshot before anything slow is done
+    scheduler = AsyncScheduler(executor=relay_executor)
+    p, writer = hat.make_porssari(relay_function, state_path,
+                                  scheduler=scheduler, fetch_pool=fetch_executor)
+    p.load_spot_cache()
+
+    renderer = hat.make_renderer(p)
+    httpd = await pricecutter_httpserver.start_async_httpserver(p, port, display=renderer,
+                                                                executor=http_executor,
+                                                                admin=hat.admin_endpoints)
+    tasks = [loop.create_task(scheduler.run_async(), name="scheduler"),
+             loop.create_task(fetch_loop(p, fetch_executor), name="fetcher"),
+             loop.create_task(display_loop(renderer, executor), name="display")]
+    log.info("Running on one event loop")
+    try:
+        await stopping.wait()
+    finally:
+        log.info("Shutting down")
+        httpd.close()
+        profiling.PROFILER.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # The relays are left in a defined state without waiting for a
+        # running fetch or request, the snapshot keeps the schedule state
+        # for the next start
+        relays_frozen.set()
+        for id in hat.hat_relays:
+            hat.set_relay(id, hat.shutdown_state)
+        p.stop()
+        writer.save()
+        log.flush()
+        for pool in (fetch_executor, relay_executor, http_executor, executor):
+            pool.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == "__main__":
+    print("""pricecutter_async.py
+
+This Automation HAT Mini application uses electricity price service to
+cut off most expensive hours from relay.
+
+Send SIGTERM or press CTRL+C to exit.
+""")
+    # Keep the log in memory, write it to the SD card in batches
+    log.configure(path="pricecutter.log", echo=False)
+    asyncio.run(main())
@@ -5,10 +5,28 @@ for getting the status of the control module with HTTP.
 """
 
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import asyncio
 import time
 import datetime
 import base64
-from threading import Thread, current_thread
+import copy
+import gzip
+import hashlib
+import io
+import ipaddress
+import json
+import math
+import os
+import queue
+import string
+from threading import Lock, Thread, current_thread
+from urllib.parse import parse_qs, urlsplit
+
+import log
+import metrics
+import profiling
+from porssari import State
+from spotprice import SpotPrices
 
 html="""
 <html>
@@ -35,6 +53,7 @@ $POWER<br>
 </body>
 </html>
 """
+html_template = string.Template(html)
 
 FAVICON_BASE64="""
 AAABAAEAEBAAAAEAIAAoBAAAFgAAACgAAAAQAAAAIAAAAAEAIAAAAAAAAAAAAAAAAAAAAAAAAAAA
@@ -58,100 +77,692 @@ AP8AAAD/AAAA/wAAAP8AAAD/AAAA/wAAAP8AAAD/AAAA/wAAAP8AAAD/AAAA/wAAAP8AAAD/AAAA
 AAAA/wAAAP8AAAD/AAAA/wAAAP8AAAD/AAAA/wAAAP8AAAD/AAAA/wAAAP8AAAD/AAAA/wAAAP8A
 AAD/"""
 
+LOG_LEVELS = {"debug": log.DEBUG, "info": log.INFO, "warning": log.WARNING, "error": log.ERROR}
+
+# Known paths used as metric labels
+ROUTES = ("/", "/favicon.ico", "/script.js", "/metrics", "/display.png", "/chart.svg",
+          "/api/state", "/api/schedule", "/api/prices", "/api/savings", "/api/events",
+          "/logs", "/admin/profile", "/admin/memory", "/admin/threads")
+
 class PriceCutterHttpHandler(BaseHTTPRequestHandler):
     timeout = 1
 
-    def __init__(self, porssari):
+    def __init__(self, porssari, events=None, display=None, admin=None):
         self.porssari = porssari
+        self.events = events
+        self.admin = admin # None, "local" or "all" clients served /admin/
+        self.page = PageCache(render_page)
+        self.api = {
+            "/api/schedule": PageCache(render_schedule, "application/json", per_minute=False,
+                                       version=lambda state: state.response_version),
+            "/api/prices": PageCache(render_prices, "application/json", per_minute=False,
+                                     version=lambda state: state.spot_version),
+            "/chart.svg": PageCache(render_chart, "image/svg+xml", per_minute=False,
+                                    version=lambda state: (state.response_version, state.spot_version)),
+        }
+        self.assets = {
+            "/favicon.ico": StaticAsset(lambda: base64.b64decode(FAVICON_BASE64),
+                                        "image/x-icon", "max-age=86400"),
+            "/script.js": StaticFile("script.js", "text/javascript"),
+            "/display.png": DisplayFrame(display),
+        }
 
     def __call__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        # Handle each request in its own copy so that concurrent requests
+        # do not share the request state, the caches are shared.
+        handler = copy.copy(self)
+        BaseHTTPRequestHandler.__init__(handler, *args, **kwargs)
         
     def do_GET(self):
-        if "/favicon.ico" in self.path:
-        # Send the favicon response
-            self.send_response(200)
-            self.send_header('Content-Type', 'image/x-icon')
-            self.end_headers()
-
-            # Write the binary data for the favicon
-            favicon_data = base64.b64decode(FAVICON_BASE64)
-            self.wfile.write(favicon_data)
+        path = urlsplit(self.path).path
+        if path in self.assets:
+            content = self.assets[path].get()
+            if content is None:
+                self.send_error(404)
+            else:
+                self.send_content(content)
+            return
+        if path in self.api:
+            self.send_content(self.api[path].get(self.porssari))
             return
-        if "/script.js" in self.path:
-            with open("script.js", "rb") as f:
-                self.send_response(200)
-                self.send_header("Content-Type", "text/javascript")
-                self.end_headers()
-                self.wfile.write(f.read())
+        if path == "/api/state":
+            body = json.dumps(render_state(self.porssari)).encode()
+            self.send_content(CachedContent(body, "application/json"))
+            return
+        if path == "/api/savings":
+            period = parse_qs(urlsplit(self.path).query).get("period", [None])[0]
+            savings = self.porssari.get_savings(period)
+            if savings is None:
+                self.send_error(404)
+                return
+            body = json.dumps(savings).encode()
+            self.send_content(CachedContent(body, "application/json"))
+            return
+        if path == "/logs":
+            query = parse_qs(urlsplit(self.path).query)
+            level = LOG_LEVELS.get(query.get("level", ["debug"])[0].lower(), log.DEBUG)
+            try:
+                limit = int(query.get("limit", ["500"])[0])
+            except ValueError as e:
+                self.send_error(400, str(e))
                 return
+            body = "\n".join(log.LOG.format(record) for record in log.LOG.tail(level, limit))
+            self.send_content(CachedContent(body.encode(), "text/plain; charset=utf-8",
+                                            gzip_min_size=512))
+            return
+        if path.startswith("/admin/"):
+            if not self.admin_allowed():
+                self.send_error(404)
+                return
+            self.send_admin(path, parse_qs(urlsplit(self.path).query))
+            return
+        if path == "/metrics":
+            body = metrics.REGISTRY.exposition().encode()
+            self.send_content(CachedContent(body, "text/plain; version=0.0.4"))
+            return
+        if path == "/api/events" and self.events:
+            self.send_event_stream()
+            return
+        if path != "/":
+            self.send_error(404)
+            return
+        self.send_content(self.page.get(self.porssari))
+
+    def admin_allowed(self):
+        """The profiling endpoints are off by default, "local" serves them
+        only to the device itself e.g. over an ssh tunnel."""
+        if self.admin == "all":
+            return True
+        if self.admin == "local":
+            try:
+                return ipaddress.ip_address(self.client_address[0]).is_loopback
+            except ValueError:
+                return False
+        return False
+
+    def send_admin(self, path, query):
+        """Profiling endpoints, nothing runs or is traced until requested:
+        /admin/profile?seconds=5&interval=0.01 samples all threads and returns
+        collapsed stacks for flame graphs, /admin/memory?action=start|snapshot|diff|stop
+        controls tracemalloc and /admin/threads lists the threads and timers."""
+        def number(name, default, type=float):
+            value = type(query.get(name, [default])[0])
+            if not math.isfinite(value):
+                raise ValueError(f"{name} must be finite")
+            return value
+        try:
+            if path == "/admin/profile":
+                stacks = profiling.PROFILER.profile(number("seconds", 5), number("interval", 0.01))
+                if stacks is None:
+                    self.send_error(409, "Profile already running")
+                    return
+                content = CachedContent(stacks.encode(), "text/plain; charset=utf-8", gzip_min_size=512)
+            elif path == "/admin/memory":
+                action = query.get("action", ["status"])[0]
+                limit = number("limit", 20, int)
+                key = query.get("key", ["lineno"])[0]
+                if action == "start":
+                    result = profiling.TRACER.start(number("frames", 1, int))
+                elif action == "stop":
+                    result = profiling.TRACER.stop()
+                elif action == "snapshot":
+                    result = profiling.TRACER.snapshot(limit, key)
+                elif action == "diff":
+                    result = profiling.TRACER.diff(limit, key)
+                elif action == "status":
+                    result = profiling.TRACER.status()
+                else:
+                    self.send_error(400, "Unknown action")
+                    return
+                content = CachedContent(json.dumps(result).encode(), "application/json", gzip_min_size=512)
+            elif path == "/admin/threads":
+                result = {"threads": profiling.thread_inventory(), "timers": self.get_timers()}
+                content = CachedContent(json.dumps(result).encode(), "application/json", gzip_min_size=512)
+            else:
+                self.send_error(404)
+                return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_content(content)
+
+    def get_timers(self):
+        return self.porssari.get_timers()
+
+    def log_message(self, format, *args):
+        log.debug(self.address_string(), format % args)
+
+    def log_request(self, code='-', size='-'):
+        # path is not set when the request line could not be parsed
+        path = urlsplit(getattr(self, "path", "")).path
+        if path not in ROUTES:
+            path = "other"
+        metrics.http_requests.labels(path, int(code)).inc()
+        super().log_request(code, size)
+
+    def send_event_stream(self):
+        """Send the event stream headers and the current state and hand the
+        connection over to the EventStream thread."""
         self.send_response(200)
-        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
         self.end_headers()
-        DATE = datetime.datetime.now().replace(microsecond=0).isoformat()
-        state = self.porssari.get_state("1")
-        POWER="Power: OFF"
-        if state == "1":
-            POWER="Power: ON"
-        UPDATE=self.porssari.get_time_to_relay_update()
-        MODES = ""
-        PRICE = ""
-        hours = self.porssari.get_on_off_hours(accuracy=3600)
-        spot_array = self.porssari.get_spot_price()
-        price = "0.0"
-        if len(hours) > 0:
-            sorted_hours = sorted(hours.keys())
-            start_time = sorted_hours[0]
-            start_datetime = datetime.datetime.fromtimestamp(start_time)
-            start_hour = start_datetime.hour
-            start_minute = start_datetime.minute
-            last_printed_hour = ""
-            for t in hours:
-                t0 = t - start_time
-                hour = t0 / 3600
-                state = hours[t]
-                t_datetime = datetime.datetime.fromtimestamp(t)
-                thour = t_datetime.hour
-
-                lookup_time = f"{t_datetime.year}-{t_datetime.month:02d}-{t_datetime.day:02d}T{thour:02d}"
-                for spot in spot_array:
-                    if lookup_time in spot.get('DateTime'):
-                        priceNoTax = spot.get('PriceNoTax', 0)*1000 ## convert EUR/kWh to EUR/MWh
-                        price = f"{priceNoTax:.1f}"
-                        if PRICE == "":
-                            PRICE = f"{priceNoTax:.1f} &#8364;/MWh {priceNoTax/10:.2f} c/kWh"
-                        
-                if state == '0':
-                    c = "red"
-                else:
-                    c = "lime"
-                MODES = MODES + f'<button class="default" title="H00" style="color:black;padding:1px 1px;background-color:{c};width:40px;border:1px solid white;height:40px;font-size:12px">{thour}<br>{price}</button>'
-            
-        body = html.replace("$DATE", DATE) \
-             .replace("$POWER", POWER) \
-             .replace("$UPDATE", UPDATE) \
-             .replace("$PRICE", PRICE) \
-             .replace("$MODES", MODES)
+        self.wfile.write(self.initial_event())
+        self.wfile.flush()
+        self.close_connection = True
+        self.server.detach(self.connection)
+        self.events.subscribe(self.connection)
+
+    def initial_event(self):
+        return format_event("state", render_state(self.porssari))
+
+    def send_content(self, content):
+        """Send cached content answering conditional and gzip requests."""
+        etag = content.etag
+        body = content.body
+        gzipped = content.gzip_min_size is not None and len(body) >= content.gzip_min_size \
+            and "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            etag = etag[:-1] + '-gz"'
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        if gzipped:
+            body = content.gzipped()
+        self.send_response(200)
+        self.send_header("Content-Type", content.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", content.cache_control)
+        if content.gzip_min_size is not None:
+            self.send_header("Vary", "Accept-Encoding")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class CachedContent:
+    """Response body kept in memory with a strong ETag and a lazily
+    compressed gzip variant."""
+
+    def __init__(self, body, content_type, cache_control="no-cache", gzip_min_size=None):
+        self.body = body
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.gzip_min_size = gzip_min_size # None disables gzip
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.gzip_body = None
+
+    def gzipped(self):
+        if self.gzip_body is None:
+            self.gzip_body = gzip.compress(self.body, mtime=0)
+        return self.gzip_body
+
+
+class StaticAsset:
+    """In-memory asset whose body is produced once on first use."""
+
+    def __init__(self, load, content_type, cache_control="no-cache"):
+        self.load = load
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.content = None
+
+    def get(self):
+        if self.content is None:
+            self.content = CachedContent(self.load(), self.content_type, self.cache_control)
+        return self.content
+
+
+class StaticFile:
+    """File kept in memory and reloaded only when its mtime changes. The
+    mtime is checked at most every check_interval seconds."""
+
+    def __init__(self, path, content_type, cache_control="no-cache",
+                 check_interval=5, gzip_min_size=512):
+        self.path = path
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.check_interval = check_interval
+        self.gzip_min_size = gzip_min_size
+        self.mtime = None
+        self.checked = 0
+        self.content = None
+        self.lock = Lock()
+
+    def get(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked < self.check_interval:
+                return self.content
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self.mtime:
+                    with open(self.path, "rb") as f:
+                        body = f.read()
+                    self.content = CachedContent(body, self.content_type, self.cache_control,
+                                                 gzip_min_size=self.gzip_min_size)
+                    self.mtime = mtime
+            except OSError:
+                self.content = None
+                self.mtime = None
+            return self.content
+
+
+class DisplayFrame:
+    """Last frame of the display loop as png. The frame is encoded on the
+    first request after it changed, serving it does not render anything."""
+
+    def __init__(self, display):
+        self.display = display
+        self.png = None
+        self.content = None
+
+    def get(self):
+        png = self.display.get_png() if self.display else None
+        if png is None:
+            return None
+        if png is not self.png:
+            self.content = CachedContent(png, "image/png")
+            self.png = png
+        return self.content
+
+
+class PageCache:
+    """Content rendered once per porssari state version and optionally
+    per minute. The version function selects the part of the state the
+    content depends on."""
+
+    def __init__(self, render, content_type="text/html; charset=utf-8",
+                 per_minute=True, gzip_min_size=512, version=None):
+        self.render = render
+        self.content_type = content_type
+        self.per_minute = per_minute
+        self.gzip_min_size = gzip_min_size
+        self.version = version or (lambda state: state.version)
+        self.key = None
+        self.content = None
+        self.renders = 0
+        self.lock = Lock()
+
+    def get(self, porssari):
+        state = porssari.state
+        key = self.version(state)
+        if self.per_minute:
+            key = (key, int(time.time() / 60))
+        with self.lock:
+            if key != self.key:
+                start = time.perf_counter()
+                body = self.render(porssari, state).encode()
+                metrics.page_render_seconds.labels(self.render.__name__).observe(time.perf_counter() - start)
+                self.content = CachedContent(body, self.content_type,
+                                             gzip_min_size=self.gzip_min_size)
+                self.key = key
+                self.renders += 1
+            return self.content
+
 
-        self.wfile.write(body.encode())
+def channel_label(timeline):
+    return f"{timeline.channel} {timeline.name}" if timeline.name else timeline.channel
 
 
-def start_pricecutter_httpserver(porssari):
+def render_page(porssari, state=None):
+    """Render the status page html of the porssari state."""
+    state = state or porssari.state
+    DATE = datetime.datetime.now().replace(microsecond=0).isoformat()
+    timelines = state.timelines or {"1": None}
+    POWER = []
+    for channel, timeline in timelines.items():
+        power = "ON" if state.relays.get(channel) == "1" else "OFF"
+        if len(timelines) == 1:
+            POWER.append(f"Power: {power}")
+        else:
+            POWER.append(f"{channel_label(timeline)}: {power}")
+    UPDATE=porssari.get_time_to_relay_update()
+    MODES = []
+    PRICE = ""
+    spot_prices = state.spot_prices
+    current = spot_prices.price_at(time.time())
+    if current is not None:
+        priceNoTax = current*1000 ## convert EUR/kWh to EUR/MWh
+        PRICE = f"{priceNoTax:.1f} &#8364;/MWh {priceNoTax/10:.2f} c/kWh"
+    # The hour labels and prices are shared by the channels
+    labels = {}
+    price = "0.0"
+    for timeline in state.timelines.values():
+        for t in timeline.get_on_off_hours(3600):
+            if t not in labels:
+                hour_price = spot_prices.average(t, t + 3600)
+                if hour_price is not None:
+                    price = f"{hour_price*1000:.1f}"
+                labels[t] = f"{datetime.datetime.fromtimestamp(t).hour}<br>{price}"
+    for timeline in state.timelines.values():
+        hours = timeline.get_on_off_hours(3600)
+        if len(state.timelines) > 1:
+            MODES.append(f"<br>{channel_label(timeline)}<br>")
+        for t in hours:
+            if hours[t] == '0':
+                c = "red"
+            else:
+                c = "lime"
+            MODES.append(f'<button class="default" title="H00" style="color:black;padding:1px 1px;background-color:{c};width:40px;border:1px solid white;height:40px;font-size:12px">{labels[t]}</button>')
+
+    return html_template.substitute(DATE=DATE, POWER="<br>".join(POWER), UPDATE=UPDATE,
+                                    PRICE=PRICE, MODES="".join(MODES))
+
+
+def render_state(porssari, state=None):
+    """Current relay states, next relay update and price as dict."""
+    state = state or porssari.state
+    now = time.time()
+    next_update = porssari.get_next_relay_update()
+    if next_update:
+        next_update = {"timestamp": next_update[0], "id": next_update[1], "state": next_update[2]}
+    return {
+        "time": int(now),
+        "version": state.version,
+        "relays": dict(state.relays),
+        "next_update": next_update,
+        "price": state.spot_prices.price_at(now),
+    }
+
+
+def render_schedule(porssari, state=None):
+    """Schedule of the latest control response as json. The top level
+    state and schedules are of the first channel."""
+    state = state or porssari.state
+    timeline = state.timeline
+    if timeline is None:
+        return json.dumps({})
+    channels = {}
+    for channel, timeline in state.timelines.items():
+        channels[channel] = {
+            "name": timeline.name,
+            "state": timeline.start_state,
+            "schedules": [{"timestamp": t, "state": power}
+                          for t, power in zip(timeline.times, timeline.states)],
+        }
+    first = channels[state.timeline.channel]
+    return json.dumps({
+        "version": timeline.version,
+        "start_time": timeline.start_time,
+        "valid_until": timeline.end_time,
+        "state": first["state"],
+        "schedules": first["schedules"],
+        "channels": channels,
+    })
+
+
+def render_prices(porssari, state=None):
+    """Spot price series as json, prices in EUR/kWh."""
+    spot_prices = (state or porssari.state).spot_prices
+    return json.dumps({
+        "duration": spot_prices.duration,
+        "times": spot_prices.times.tolist(),
+        "prices": spot_prices.prices.tolist(),
+        "prices_with_tax": spot_prices.prices_with_tax.tolist(),
+    })
+
+
+CHART_WIDTH = 720
+CHART_HEIGHT = 200
+CHART_MARGIN = (40, 10, 10, 24) # left, top, right, bottom
+
+def render_chart(porssari, state=None):
+    """Spot prices over the relay on/off timelines of the channels as svg."""
+    state = state or porssari.state
+    timelines = list(state.timelines.values())
+    spot_prices = state.spot_prices
+    starts = []
+    ends = []
+    for timeline in timelines[:1]:
+        starts.append(timeline.start_time)
+        ends.append(timeline.end_time)
+    if len(spot_prices):
+        starts.append(spot_prices.start_time())
+        ends.append(spot_prices.end_time())
+    svg = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{CHART_WIDTH}" height="{CHART_HEIGHT}" '
+           f'viewBox="0 0 {CHART_WIDTH} {CHART_HEIGHT}" font-family="sans-serif" font-size="10">',
+           '<rect width="100%" height="100%" fill="black"/>']
+    if not starts:
+        svg.append('<text x="50%" y="50%" fill="grey" text-anchor="middle">No data</text></svg>')
+        return "".join(svg)
+    left, top, right, bottom = CHART_MARGIN
+    width = CHART_WIDTH - left - right
+    height = CHART_HEIGHT - top - bottom
+    start = int(min(starts) / 3600) * 3600
+    end = max(ends)
+    def x(t):
+        return left + (min(max(t, start), end) - start) * width / (end - start)
+    # Relay states as background bands, one row per channel
+    row = height / max(1, len(timelines))
+    for i, timeline in enumerate(timelines):
+        t = timeline.start_time
+        power = timeline.start_state
+        for change, next_power in zip(list(timeline.times) + [timeline.end_time],
+                                     list(timeline.states) + [None]):
+            if change > t:
+                c = "lime" if power == "1" else "red"
+                svg.append(f'<rect x="{x(t):.1f}" y="{top + i * row:.1f}" width="{x(change) - x(t):.1f}" '
+                           f'height="{row:.1f}" fill="{c}" fill-opacity="0.3"/>')
+            t = max(t, change)
+            power = next_power
+        if len(timelines) > 1:
+            svg.append(f'<text x="{left + 2}" y="{top + i * row + 10:.1f}" fill="grey">{timeline.channel}</text>')
+    # Spot prices in c/kWh as steps
+    if len(spot_prices):
+        prices = [price * 100 for price in spot_prices.prices]
+        low = min(0.0, min(prices))
+        high = max(prices)
+        if high <= low:
+            high = low + 1
+        def y(price):
+            return top + (high - price) * height / (high - low)
+        step_ends = list(spot_prices.times[1:]) + [spot_prices.end_time()]
+        path = []
+        for t, t_end, price in zip(spot_prices.times, step_ends, prices):
+            path.append(f"{'M' if not path else 'L'}{x(t):.1f},{y(price):.1f}H{x(t_end):.1f}")
+        svg.append(f'<path d="{"".join(path)}" fill="none" stroke="orange" stroke-width="1.5"/>')
+        for price in (low, high):
+            svg.append(f'<text x="{left - 4}" y="{y(price) + 3:.1f}" fill="white" '
+                       f'text-anchor="end">{price:.1f}</text>')
+        svg.append(f'<text x="{left - 4}" y="{CHART_HEIGHT - 4}" fill="grey" text-anchor="end">c/kWh</text>')
+    # Hour ticks, date at midnight
+    for t in range(start, int(end) + 1, 3600):
+        hour = datetime.datetime.fromtimestamp(t)
+        if hour.hour % 3:
+            continue
+        svg.append(f'<line x1="{x(t):.1f}" y1="{top + height}" x2="{x(t):.1f}" y2="{top + height + 4}" stroke="grey"/>')
+        label = hour.strftime("%d.%m.") if hour.hour == 0 else str(hour.hour)
+        svg.append(f'<text x="{x(t):.1f}" y="{CHART_HEIGHT - 8}" fill="white" text-anchor="middle">{label}</text>')
+    svg.append('</svg>')
+    return "".join(svg)
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class EventStream:
+    """Server-Sent Events fan out to any number of subscribers from one
+    thread. The subscriber sockets are detached from the request handler
+    threads so no thread is blocked per subscriber."""
+
+    def __init__(self, keepalive=15, send_timeout=1):
+        self.keepalive = keepalive
+        self.send_timeout = send_timeout
+        self.clients = []
+        self.queue = queue.Queue()
+        self.thread = Thread(target=self.run, name="EventStream", daemon=True)
+        self.thread.start()
+
+    def subscribe(self, connection):
+        self.queue.put(("subscribe", connection))
+
+    def publish(self, event, data):
+        """Queue an event to all subscribers, this call does not block."""
+        self.queue.put((event, data))
+
+    def run(self):
+        while True:
+            try:
+                event, data = self.queue.get(timeout=self.keepalive)
+            except queue.Empty:
+                event, data = None, None
+            if event == "subscribe":
+                data.settimeout(self.send_timeout)
+                self.clients.append(data)
+                continue
+            message = b": keepalive\n\n" if event is None else format_event(event, data)
+            for connection in list(self.clients):
+                try:
+                    connection.sendall(message)
+                except OSError:
+                    self.clients.remove(connection)
+                    connection.close()
+
+
+class PriceCutterHttpServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer which lets handlers detach long lived
+    connections from the request thread."""
+
+    def __init__(self, *args, **kwargs):
+        self.detached = set()
+        super().__init__(*args, **kwargs)
+
+    def detach(self, connection):
+        self.detached.add(connection)
+
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        super().shutdown_request(request)
+
+
+class AsyncHttpServer:
+    """Serves a PriceCutterHttpHandler on an asyncio event loop. The loop
+    reads the requests and writes the responses, only the handler runs in
+    the executor, and the event stream subscribers are tasks, so no thread
+    is used per connection. One request per connection as with HTTP/1.0."""
+
+    def __init__(self, handler, executor=None, keepalive=15, send_timeout=1,
+                 timeout=5, max_queued=16):
+        self.handler = handler
+        self.executor = executor
+        self.keepalive = keepalive
+        self.send_timeout = send_timeout
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.subscribers = {} # event queue -> task of the subscriber
+        self.loop = None
+        self.server = None
+
+    async def start(self, port=3000):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.serve_connection, port=port,
+                                                 reuse_address=True)
+        return self
+
+    def close(self):
+        self.server.close()
+        for task in list(self.subscribers.values()):
+            task.cancel()
+
+    def publish(self, event, data):
+        """Porssari listener, may be called from any thread."""
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.broadcast, format_event(event, data))
+            except RuntimeError:
+                pass # loop already closed
+
+    def broadcast(self, message):
+        for queue, task in list(self.subscribers.items()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too slow subscriber
+                task.cancel()
+
+    async def serve_connection(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+            path = urlsplit(request.split(b" ", 2)[1].decode("latin-1")).path
+            if path == "/api/events":
+                await self.send_event_stream(writer)
+                return
+            response = await self.loop.run_in_executor(
+                self.executor, self.respond, request, writer.get_extra_info("peername"))
+            writer.write(response)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, IndexError):
+            pass
+        except asyncio.CancelledError:
+            pass # closed or too slow event stream subscriber
+        except Exception as e:
+            log.exception("Error in HTTP request:", e)
+        finally:
+            writer.close()
+
+    def respond(self, request, peer):
+        """Run the handler on the buffered request, returns the response."""
+        handler = copy.copy(self.handler)
+        handler.client_address = peer or ("", 0)
+        handler.server = self
+        handler.request = handler.connection = None
+        handler.rfile = io.BytesIO(request)
+        handler.wfile = io.BytesIO()
+        handler.close_connection = True
+        handler.handle_one_request()
+        return handler.wfile.getvalue()
+
+    async def send_event_stream(self, writer):
+        queue = asyncio.Queue(self.max_queued)
+        self.subscribers[queue] = asyncio.current_task()
+        metrics.http_requests.labels("/api/events", 200).inc()
+        try:
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\n\r\n" + self.handler.initial_event())
+            while True:
+                await asyncio.wait_for(writer.drain(), self.send_timeout)
+                try:
+                    message = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    message = b": keepalive\n\n"
+                writer.write(message)
+        finally:
+            del self.subscribers[queue]
+
+
+def start_pricecutter_httpserver(porssari, port=3000, display=None, admin=None):
     """Start http server.
 
     Parameters
     ----------
     porssari: porssari object providing methods to fetch current state, 
     time to update and next hours relay states.
+    port: port to listen, 0 selects a free port.
+    display: optional DisplayRenderer whose last frame is served as
+    /display.png.
+    admin: clients served the /admin/ profiling endpoints, None for no
+    one, "local" for the loopback clients only or "all".
     """
     def serve_forever(httpd):
         httpd.timeout = 1
         with httpd:
             httpd.serve_forever()
 
-    port = 3000
-    handler = PriceCutterHttpHandler(porssari)
-    httpd = ThreadingHTTPServer(('', port), handler)
+    events = EventStream()
+    porssari.add_listener(events.publish)
+    handler = PriceCutterHttpHandler(porssari, events, display, admin)
+    httpd = PriceCutterHttpServer(('', port), handler)
     httpd.timeout = 1
     httpd.allow_reuse_address = True
     #httpd.server_bind() ## Already called in HTTPServer
@@ -161,6 +772,17 @@ def start_pricecutter_httpserver(porssari):
     thread.start()
     return httpd
 
+async def start_async_httpserver(porssari, port=3000, display=None, executor=None, admin=None):
+    """Start the http server on the running asyncio event loop.
+
+    The parameters are as with start_pricecutter_httpserver(), the
+    handlers run in executor, the default executor of the loop if None.
+    Returns the AsyncHttpServer, close() stops it.
+    """
+    server = AsyncHttpServer(PriceCutterHttpHandler(porssari, None, display, admin), executor)
+    porssari.add_listener(server.publish)
+    return await server.start(port)
+
 #######################################################################
 # Test code
 
@@ -172,21 +794,42 @@ class MockPorssari:
                  relay_cb=None, # usage relay_cb(relay_id, state)
                  update_interval = 15*60): # fetch data by default in 15 minute
         self.relay_cb = relay_cb
-        self.relays = {}
+        self.state = State()
         pass
 
     def start(self):
-        self.relays["1"] = "1"
+        self.state = self.state.replace(relays={"1": "1"})
         relay_cb("1","1")
 
-    def get_on_off_hours(self):
-        return []
+    def get_on_off_hours(self, accuracy=900):
+        return {}
+
+    def get_spot_prices(self):
+        return SpotPrices()
 
     def get_time_to_relay_update(self):
         return "10m"
 
+    def get_next_relay_update(self):
+        return None
+
+    def get_timeline(self):
+        return None
+
+    def add_listener(self, listener):
+        pass
+
+    def get_version(self):
+        return self.state.version
+
     def get_state(self, id):
-        return self.relays.get(id)
+        return self.state.relays.get(id)
+
+    def get_timers(self):
+        return []
+
+    def get_savings(self, period=None):
+        return None
 
 mockrelays = {}
     
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+# profiling.py - on-demand sampling profiler, memory tracing and thread inventory
+
+from collections import Counter
+import math
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+class SamplingProfiler:
+    '''
+    Samples the stacks of all threads with sys._current_frames() from the
+    requesting thread for a bounded time. Nothing runs between profiles,
+    so there is no overhead while not profiling. One profile at a time.
+    '''
+    def __init__(self, max_seconds=60, min_interval=0.005):
+        self.max_seconds = max_seconds
+        self.min_interval = min_interval
+        self.labels = {} # code object to frame label
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.labels[code] = label
+        return label
+
+    def profile(self, seconds=5.0, interval=0.01):
+        '''
+        Returns the collapsed stacks "thread;outer;...;inner count" of the
+        samples, one stack per line as used by flamegraph.pl and
+        speedscope, or None if another profile is running.
+        '''
+        if not (math.isfinite(seconds) and math.isfinite(interval)):
+            raise ValueError("seconds and interval must be finite")
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            self.cancelled.clear()
+            seconds = min(max(seconds, 0.0), self.max_seconds)
+            interval = max(interval, self.min_interval)
+            me = threading.get_ident()
+            counts = Counter()
+            end = time.monotonic() + seconds
+            while True:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self.label(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    counts[";".join(reversed(stack))] += 1
+                if time.monotonic() + interval > end or self.cancelled.wait(interval):
+                    break
+            # Code objects of the profile only, do not keep them alive
+            self.labels = {}
+        finally:
+            self.lock.release()
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+    def cancel(self):
+        '''
+        End a running profile early, e.g. when shutting down.
+        '''
+        self.cancelled.set()
+
+class MemoryTracer:
+    '''
+    tracemalloc is started only on request and stopped again after the
+    investigation, while stopped the allocations are not traced at all.
+    Each snapshot becomes the baseline of the next diff.
+    '''
+    def __init__(self):
+        self.baseline = None
+        self.lock = threading.Lock()
+
+    def start(self, frames=1):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                self.baseline = None
+            return self.status()
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.baseline = None
+            return self.status()
+
+    def status(self):
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {"tracing": tracing, "traced_bytes": current, "peak_bytes": peak,
+                "frames": tracemalloc.get_traceback_limit() if tracing else 0}
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def snapshot(self, limit=20, key="lineno"):
+        '''
+        Returns the top allocations by key, "lineno", "filename" or
+        "traceback", and sets the baseline for diff().
+        '''
+        with self.lock:
+            status = self.status()
+            if not status["tracing"]:
+                return status
+            snapshot = self.take_snapshot()
+            self.baseline = snapshot
+            status["top"] = [{"where": format_traceback(stat.traceback),
+                              "size": stat.size, "count": stat.count}
+                             for stat in snapshot.statistics(key)[:limit]]
+            return status
+
+    def diff(self, limit=20, key="lineno"):
+        '''
+        Returns the largest changes since the baseline, the first diff
+        after start() compares against an empty snapshot.
+        '''
+        with self.lock:
+            status = self.status()
+            if not status["tracing"]:
+                return status
+            snapshot = self.take_snapshot()
+            if self.baseline is None:
+                stats = snapshot.statistics(key)
+                top = [{"where": format_traceback(stat.traceback),
+                        "size_diff": stat.size, "count_diff": stat.count,
+                        "size": stat.size, "count": stat.count}
+                       for stat in stats[:limit]]
+            else:
+                stats = snapshot.compare_to(self.baseline, key)
+                top = [{"where": format_traceback(stat.traceback),
+                        "size_diff": stat.size_diff, "count_diff": stat.count_diff,
+                        "size": stat.size, "count": stat.count}
+                       for stat in stats[:limit]]
+            self.baseline = snapshot
+            status["top"] = top
+            return status
+
+def format_traceback(traceback):
+    return [f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in traceback]
+
+def thread_inventory(depth=3):
+    '''
+    Returns the live threads with the innermost depth frames of their
+    stacks.
+    '''
+    frames = sys._current_frames()
+    threads = []
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stack = []
+        while frame is not None and len(stack) < depth:
+            stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        threads.append({
+            "name": thread.name,
+            "ident": thread.ident,
+            "native_id": thread.native_id,
+            "daemon": thread.daemon,
+            "alive": thread.is_alive(),
+            "timer": isinstance(thread, threading.Timer),
+            "stack": stack,
+        })
+    return threads
+
+PROFILER = SamplingProfiler()
+TRACER = MemoryTracer()
+
+
+def test():
+    import json
+    def busy():
+        end = time.monotonic() + 0.5
+        while time.monotonic() < end:
+            sum(range(1000))
+    thread = threading.Thread(target=busy, name="Busy")
+    thread.start()
+    print(PROFILER.profile(0.3, 0.01))
+    thread.join()
+    TRACER.start()
+    TRACER.snapshot()
+    garbage = [str(i) * 10 for i in range(10000)]
+    print(json.dumps(TRACER.diff(limit=3), indent=1))
+    TRACER.stop()
+    print(json.dumps(thread_inventory(), indent=1))
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+"""
+Replay recorded control and spot responses through Porssari with a
+virtual clock, thousands of times faster than real time.
+
+The recordings are json files: porssari.json captures of control
+responses, spot-hinta.fi results, or JSON lines files where each line is
+{"time": epoch, "control": {...}} or {"time": epoch, "spot": [...]}.
+A control response becomes available at its metadata timestamp and is
+picked up at the next simulated poll. Every relay transition is logged
+with its timestamp and the switching accuracy is measured against the
+state the latest available response prescribes.
+
+    python3 replay.py captures/*.json --interval 300
+"""
+
+import argparse
+import datetime
+import json
+import sys
+
+import porssari
+from clock import VirtualClock
+
+def load_recordings(paths):
+    '''
+    Returns list of (time, kind, payload) sorted by time, kind is
+    "control" or "spot".
+    '''
+    recordings = []
+    for path in paths:
+        with open(path) as f:
+            text = f.read()
+        try:
+            items = [json.loads(text)]
+        except ValueError:
+            items = [json.loads(line) for line in text.splitlines() if line.strip()]
+        for item in items:
+            if isinstance(item, dict) and "sha256" in item and "data" in item:
+                # persist.ChecksummedFile cache, e.g. porssari.json
+                item = item["data"]
+            if isinstance(item, list):
+                # spot-hinta.fi result, available from its first slot
+                t = datetime.datetime.fromisoformat(item[0]['DateTime']).timestamp()
+                recordings.append((int(t), "spot", item))
+            elif "controls" in item:
+                recordings.append((int(item['metadata']['timestamp']), "control", item))
+            elif "control" in item:
+                recordings.append((int(item['time']), "control", item['control']))
+            elif "spot" in item:
+                recordings.append((int(item['time']), "spot", item['spot']))
+    recordings.sort(key=lambda recording: recording[0])
+    return recordings
+
+class Replay:
+    '''
+    Drives a Porssari instance through the recordings with a virtual clock.
+    '''
+    def __init__(self, recordings, interval=300, sample=60, log=print, **kwargs):
+        self.recordings = recordings
+        self.interval = interval
+        self.sample = sample
+        self.log = log
+        self.clock = VirtualClock(recordings[0][0] if recordings else 0)
+        self.transitions = [] # (time, channel, state)
+        self.porssari = porssari.Porssari(device_mac="REPLAY", client="replay",
+                                          relay_cb=self.relay_cb, clock=self.clock, **kwargs)
+        self.available = None # latest control response published at the current time
+        self.expected = None # timelines of the available response by channel
+        self.mismatch = 0 # seconds any relay differed from the available response
+        self.samples = 0
+
+    def relay_cb(self, channel, state):
+        t = self.clock.time()
+        self.log(datetime.datetime.fromtimestamp(t).isoformat(), "relay", channel, "->", state)
+        self.transitions.append((t, channel, state))
+
+    def expected_state(self, t):
+        if self.expected is None:
+            return None
+        return {channel: timeline.state_at(t) for channel, timeline in self.expected.items()}
+
+    def advance(self, until):
+        '''
+        Advance the clock to until, firing the scheduled relay events on
+        time and sampling the switching accuracy.
+        '''
+        scheduler = self.porssari.scheduler
+        while self.clock.time() < until:
+            next_sample = self.clock.time() + self.sample
+            event = scheduler.next_event()
+            step = min(until, next_sample)
+            if event and event[0] < step:
+                step = event[0]
+            self.clock.set(step)
+            scheduler.run_pending(self.clock.time())
+            if step == next_sample or step == until:
+                self.check_accuracy()
+
+    def check_accuracy(self):
+        expected = self.expected_state(self.clock.time())
+        if expected is None:
+            return
+        self.samples += 1
+        if any(self.porssari.get_state(channel) != state for channel, state in expected.items()):
+            self.mismatch += self.sample
+
+    def run(self, end=None):
+        if not self.recordings:
+            return self.summary()
+        p = self.porssari
+        pending = list(self.recordings)
+        if end is None:
+            last = pending[-1]
+            end = last[0] + self.interval
+            if last[1] == "control":
+                end = max(end, int(last[2]['metadata']['valid_until']))
+        poll = self.clock.time()
+        while poll <= end:
+            self.advance(poll)
+            response = None
+            while pending and pending[0][0] <= poll:
+                t, kind, payload = pending.pop(0)
+                if kind == "spot":
+                    p.apply_spot_result(payload)
+                else:
+                    response = payload
+            if response is not None:
+                self.available = response
+                self.expected = {controls['id']: porssari.Timeline(response['metadata'], controls)
+                                 for controls in response['controls'] if controls}
+                p.apply_response(response)
+            elif p.response:
+                # Same response again as the real client gets with 304
+                p.apply_response(p.response)
+            poll += self.interval
+        self.advance(end)
+        return self.summary()
+
+    def summary(self):
+        history = self.porssari.get_switch_history()
+        lateness = [actual - scheduled for scheduled, actual, channel, state in history]
+        switches = 0
+        last = {}
+        for t, channel, state in self.transitions:
+            if last.get(channel) != state:
+                switches += 1
+            last[channel] = state
+        return {
+            "transitions": len(self.transitions),
+            "switches": switches,
+            "max_lateness": max(lateness) if lateness else 0,
+            "mismatch_seconds": self.mismatch,
+            "accuracy": round(1 - self.mismatch / (self.samples * self.sample), 6) if self.samples else None,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("recordings", nargs="+")
+    parser.add_argument("--interval", type=int, default=300, help="simulated poll interval in seconds")
+    parser.add_argument("--sample", type=int, default=60, help="accuracy sampling interval in seconds")
+    args = parser.parse_args()
+    recordings = load_recordings(args.recordings)
+    # Porssari prints its progress, keep only the transitions and the summary
+    out = sys.stdout
+    replay = Replay(recordings, args.interval, args.sample,
+                    log=lambda *values: print(*values, file=out))
+    sys.stdout = sys.stderr
+    try:
+        summary = replay.run()
+    finally:
+        sys.stdout = out
+    print(json.dumps(summary))
+
+if __name__ == "__main__":
+    main()
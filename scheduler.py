@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+# scheduler.py - single threaded relay scheduler for the porssari schedules
+
+import asyncio
+from collections import deque
+import heapq
+import threading
+
+import log
+import metrics
+from clock import SYSTEM_CLOCK
+
+class RelayScheduler:
+    '''
+    Switches relays from a priority queue of (timestamp, channel, state)
+    events with one worker thread. Events of the same timestamp are passed
+    to the callback as one batch. The whole queue is replaced atomically
+    when a new schedule arrives, and the worker wakes up at least every
+    max_wait seconds to check the wall clock so that suspend or NTP jumps
+    do not make it miss transitions.
+    '''
+    def __init__(self, relay_cb, max_wait=30, history=256, clock=None):
+        self.relay_cb = relay_cb # usage relay_cb([(channel, state)])
+        self.clock = clock or SYSTEM_CLOCK
+        self.max_wait = max_wait
+        self.queue = []
+        self.lock = threading.Condition(threading.RLock())
+        self.thread = None
+        self.running = False
+        self.history = deque(maxlen=history) # (scheduled, actual, channel, state)
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name="RelayScheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def replace(self, events, current=None):
+        '''
+        Replace all pending events with events [(timestamp, channel, state)].
+        If current [(channel, state)] is given the relays are switched to it
+        while holding the lock so a firing event can not override it.
+        '''
+        queue = list(events)
+        heapq.heapify(queue)
+        with self.lock:
+            self.queue = queue
+            if current:
+                now = self.clock.time()
+                self.switch(now, now, list(current))
+            self.lock.notify_all()
+
+    def clear(self):
+        self.replace([])
+
+    def next_event(self):
+        '''
+        Returns the next pending (timestamp, channel, state) or None.
+        '''
+        with self.lock:
+            if self.queue:
+                return self.queue[0]
+        return None
+
+    def pending(self):
+        with self.lock:
+            return len(self.queue)
+
+    def switch(self, scheduled, now, changes, fired=None):
+        '''
+        Switch the relays to changes [(channel, state)]. fired lists the
+        (timestamp, channel, state) events the changes were coalesced
+        from, each is recorded to the history.
+        '''
+        try:
+            self.relay_cb(changes)
+        except Exception as e:
+            log.exception("Error in relay update:", e)
+        if fired is None:
+            fired = [(scheduled, channel, state) for channel, state in changes]
+        for timestamp, channel, state in fired:
+            self.history.append((timestamp, now, channel, state))
+
+    def run_pending(self, now=None):
+        '''
+        Fire all the events that are due at now. Returns the number of
+        events fired. After a suspend or a clock jump the missed events
+        are coalesced to the last state of each channel and switched in
+        one batch, so no relay toggles back and forth.
+        '''
+        with self.lock:
+            if now is None:
+                now = self.clock.time()
+            fired = []
+            final = {} # channel -> last due state
+            while self.queue and self.queue[0][0] <= now:
+                timestamp = self.queue[0][0]
+                group = []
+                while self.queue and self.queue[0][0] == timestamp:
+                    timestamp, channel, state = heapq.heappop(self.queue)
+                    group.append((channel, state))
+                    fired.append((timestamp, channel, state))
+                    final.pop(channel, None)
+                    final[channel] = state
+                delay = now - timestamp
+                metrics.schedule_drift_seconds.observe(delay)
+                if delay > self.max_wait:
+                    log.warning("Relay update", group, "late by", int(delay), "seconds")
+            if fired:
+                if len(final) < len(fired):
+                    log.info("Coalesced", len(fired), "missed relay updates to", list(final.items()))
+                self.switch(fired[-1][0], now, list(final.items()), fired)
+        return len(fired)
+
+    def run(self):
+        with self.lock:
+            while self.running:
+                self.run_pending()
+                wait = self.max_wait
+                if self.queue:
+                    wait = min(wait, max(0, self.queue[0][0] - self.clock.time()))
+                self.lock.wait(wait)
+
+
+class SharedScheduler(RelayScheduler):
+    '''
+    One RelayScheduler worker thread for the relays of many devices. Each
+    device uses a ScheduleView with the RelayScheduler interface, the
+    events of a view are queued with the channel (key, channel).
+    '''
+    def __init__(self, max_wait=30, history=256, clock=None):
+        super().__init__(None, max_wait=max_wait, history=history, clock=clock)
+        self.views = {}
+
+    def view(self, key, relay_cb):
+        with self.lock:
+            view = ScheduleView(self, key, relay_cb, self.history.maxlen)
+            self.views[key] = view
+            return view
+
+    def remove(self, key):
+        with self.lock:
+            self.views.pop(key, None)
+            self.queue = [event for event in self.queue if event[1][0] != key]
+            heapq.heapify(self.queue)
+
+    def replace_view(self, view, events, current=None):
+        events = sorted(events)
+        with self.lock:
+            self.queue = [event for event in self.queue if event[1][0] != view.key]
+            self.queue.extend((timestamp, (view.key, channel), state)
+                              for timestamp, channel, state in events)
+            heapq.heapify(self.queue)
+            view.events = deque(events)
+            if current:
+                now = self.clock.time()
+                view.switch(now, now, list(current))
+            self.lock.notify_all()
+
+    def switch(self, scheduled, now, changes, fired=None):
+        if fired is None:
+            fired = [(scheduled, channel, state) for channel, state in changes]
+        devices = {}
+        for (key, channel), state in changes:
+            devices.setdefault(key, ([], []))[0].append((channel, state))
+        for timestamp, (key, channel), state in fired:
+            devices.setdefault(key, ([], []))[1].append((timestamp, channel, state))
+            self.history.append((timestamp, now, (key, channel), state))
+        for key, (device_changes, device_fired) in devices.items():
+            view = self.views.get(key)
+            if view is not None:
+                view.switch(scheduled, now, device_changes, device_fired)
+
+
+class ScheduleView:
+    '''
+    The events of one device in a SharedScheduler. The shared scheduler
+    is started and stopped by its owner, not by the views.
+    '''
+    def __init__(self, scheduler, key, relay_cb, history=256):
+        self.scheduler = scheduler
+        self.key = key
+        self.relay_cb = relay_cb # usage relay_cb([(channel, state)])
+        self.events = deque() # pending (timestamp, channel, state) in order
+        self.history = deque(maxlen=history) # (scheduled, actual, channel, state)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def replace(self, events, current=None):
+        self.scheduler.replace_view(self, events, current)
+
+    def clear(self):
+        self.replace([])
+
+    def next_event(self):
+        with self.scheduler.lock:
+            if self.events:
+                return self.events[0]
+        return None
+
+    def pending(self):
+        with self.scheduler.lock:
+            return len(self.events)
+
+    def switch(self, scheduled, now, changes, fired=None):
+        # called by the shared scheduler holding its lock
+        while self.events and self.events[0][0] <= scheduled:
+            self.events.popleft()
+        try:
+            self.relay_cb(changes)
+        except Exception as e:
+            log.exception("Error in relay update:", e)
+        if fired is None:
+            fired = [(scheduled, channel, state) for channel, state in changes]
+        for timestamp, channel, state in fired:
+            self.history.append((timestamp, now, channel, state))
+
+    def run_pending(self, now=None):
+        return self.scheduler.run_pending(now)
+
+
+class AsyncScheduler(SharedScheduler):
+    '''
+    SharedScheduler run as a task of an asyncio event loop instead of a
+    worker thread: await run_async() in the loop. The due events are fired
+    in executor, so neither the lock nor the relay callbacks block the
+    loop. The views may replace their events from any thread, the task is
+    woken through the loop.
+    '''
+    def __init__(self, max_wait=30, history=256, clock=None, executor=None):
+        super().__init__(max_wait=max_wait, history=history, clock=clock)
+        self.executor = executor # the default executor of the loop if None
+        self.loop = None
+        self.wakeup = None
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.running = True
+        try:
+            while self.running:
+                # cleared before checking the queue so no replace is missed
+                self.wakeup.clear()
+                wait = await self.loop.run_in_executor(self.executor, self.run_pending_wait)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.running = False
+            self.loop = None
+
+    def run_pending_wait(self):
+        '''
+        Fire the due events, returns the seconds to the next event.
+        '''
+        with self.lock:
+            self.run_pending()
+            wait = self.max_wait
+            if self.queue:
+                wait = min(wait, max(0, self.queue[0][0] - self.clock.time()))
+            return wait
+
+    def wake(self):
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError:
+                pass # loop already closed
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def remove(self, key):
+        super().remove(key)
+        self.wake()
+
+    def replace_view(self, view, events, current=None):
+        super().replace_view(view, events, current)
+        self.wake()
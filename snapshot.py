@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# snapshot.py - persisted state of the controller for a fast and safe boot
+
+import json
+import threading
+import time
+
+import log
+import persist
+
+FORMAT = 1
+
+def save(path, data):
+    '''
+    Write the snapshot atomically and checksummed, a power cut leaves
+    either the old or the new snapshot in place. Returns True if the
+    file was written, an unchanged snapshot is not.
+    '''
+    return persist.ChecksummedFile(path).save(dict(data, format=FORMAT))
+
+def load(path):
+    '''
+    Returns the snapshot dict or None if there is no valid snapshot.
+    '''
+    data = persist.ChecksummedFile(path).load()
+    if data is None:
+        # Snapshots written before the checksum
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.info("No state snapshot loaded:", e)
+            return None
+        if not isinstance(data, dict) or "sha256" in data:
+            return None
+    if data.get("format") != FORMAT:
+        log.warning("Ignoring state snapshot of format", data.get("format"))
+        return None
+    return data
+
+class SnapshotWriter:
+    '''
+    Porssari listener writing the snapshot when the relays, the schedule
+    or the prices change. The listener only marks the snapshot dirty, a
+    background thread writes it delay seconds later, so a burst of events
+    costs one write and the relay switches are not held up by the disk.
+    An unchanged snapshot is not rewritten.
+    '''
+    def __init__(self, porssari, path="state.json", delay=5.0):
+        self.porssari = porssari
+        self.file = persist.ChecksummedFile(path)
+        self.delay = delay
+        self.dirty = False
+        self.condition = threading.Condition()
+        self.lock = threading.Lock() # serializes the writes
+        self.thread = None
+        self.writes = 0
+
+    def __call__(self, event, data):
+        with self.condition:
+            self.dirty = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="SnapshotWriter", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.dirty:
+                    self.condition.wait()
+            # Let the rest of the burst arrive
+            time.sleep(self.delay)
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the snapshot now if it changed since the last write, used
+        before exiting.
+        '''
+        with self.condition:
+            if not self.dirty:
+                return
+            self.dirty = False
+        self.save()
+
+    def save(self):
+        with self.lock:
+            try:
+                if self.file.save(dict(self.porssari.get_snapshot(), format=FORMAT)):
+                    self.writes += 1
+            except Exception as e:
+                log.error("Failed to write state snapshot:", e)
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# spotprice.py - epoch indexed spot price series parsed from spot-hinta.fi results
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+import log
+
+class SpotPrices:
+    '''
+    Spot prices stored as parallel arrays sorted by the slot start time in
+    epoch seconds. The prices are EUR/kWh as returned by spot-hinta.fi.
+    '''
+    def __init__(self, spot_result=None):
+        self.times = array('q')
+        self.prices = array('d') # PriceNoTax
+        self.prices_with_tax = array('d')
+        self.duration = 3600
+        if spot_result:
+            self.parse(spot_result)
+
+    def parse(self, spot_result):
+        rows = []
+        for spot in spot_result:
+            try:
+                t = int(datetime.fromisoformat(spot['DateTime']).timestamp())
+            except (KeyError, TypeError, ValueError) as e:
+                log.warning("Skipping invalid spot price entry:", spot, e)
+                continue
+            rows.append((t, spot.get('PriceNoTax', 0.0), spot.get('PriceWithTax', 0.0)))
+        rows.sort()
+        for t, price, price_with_tax in rows:
+            self.times.append(t)
+            self.prices.append(price)
+            self.prices_with_tax.append(price_with_tax)
+        # spot-hinta.fi has moved from 60 to 15 minute resolution, use the
+        # shortest step between the slots as the slot duration
+        steps = [b - a for a, b in zip(self.times, self.times[1:]) if b > a]
+        if steps:
+            self.duration = min(steps)
+
+    @classmethod
+    def from_series(cls, series):
+        '''
+        Create the index from the dict returned by to_series().
+        '''
+        spot_prices = cls()
+        spot_prices.times = array('q', series['times'])
+        spot_prices.prices = array('d', series['prices'])
+        spot_prices.prices_with_tax = array('d', series['prices_with_tax'])
+        spot_prices.duration = series['duration']
+        return spot_prices
+
+    def to_series(self):
+        return {
+            "duration": self.duration,
+            "times": self.times.tolist(),
+            "prices": self.prices.tolist(),
+            "prices_with_tax": self.prices_with_tax.tolist(),
+        }
+
+    def __len__(self):
+        return len(self.times)
+
+    def start_time(self):
+        return self.times[0] if self.times else None
+
+    def end_time(self):
+        return self.times[-1] + self.duration if self.times else None
+
+    def index_at(self, t):
+        i = bisect_right(self.times, t) - 1
+        if i < 0 or t >= self.times[i] + self.duration:
+            return None
+        return i
+
+    def price_at(self, t, with_tax=False):
+        '''
+        Returns the price of the slot containing t or None if not known.
+        '''
+        i = self.index_at(t)
+        if i is None:
+            return None
+        return self.prices_with_tax[i] if with_tax else self.prices[i]
+
+    def window(self, start, end, with_tax=False):
+        '''
+        Returns the prices of the slots starting within [start, end).
+        '''
+        prices = self.prices_with_tax if with_tax else self.prices
+        # include the slot already running at start
+        i = bisect_right(self.times, start) - 1
+        if i < 0 or start >= self.times[i] + self.duration:
+            i += 1
+        j = bisect_left(self.times, end)
+        return prices[i:j]
+
+    def average(self, start, end, with_tax=False):
+        prices = self.window(start, end, with_tax)
+        if not prices:
+            return None
+        return sum(prices) / len(prices)
+
+    def min(self, start, end, with_tax=False):
+        prices = self.window(start, end, with_tax)
+        return min(prices) if prices else None
+
+    def max(self, start, end, with_tax=False):
+        prices = self.window(start, end, with_tax)
+        return max(prices) if prices else None
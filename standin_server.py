@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+"""
+Local stand-in for the porssari.fi getcontrols.php and spot-hinta.fi
+TodayAndDayForward services, with configurable latency, error rates and
+malformed payloads, and a load driver running many Porssari clients
+against it.
+
+    python3 standin_server.py --port 8000
+    python3 standin_server.py --load 100 --duration 60 --interval 5 --error-rate 0.05
+
+porssari.testrun() polls http://localhost:8000/getcontrols.php? which is
+the default of the first command.
+"""
+
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+import optimizer
+from spotprice import SpotPrices
+
+class StandInServer:
+    '''
+    Stand-in porssari.fi and spot-hinta.fi server.
+
+    resolution: spot price resolution in minutes
+    publish_hour: local hour after which next day prices are available
+    update_every: seconds between the controls 'updated' bumps, None never
+    latency, jitter: response delay in seconds
+    error_rate: share of requests answered with 500
+    malformed_rate: share of requests answered with truncated json
+    control, spot: fixed payloads served instead of generated ones
+    '''
+    def __init__(self, host="127.0.0.1", port=0, resolution=15, publish_hour=14,
+                 update_every=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                 malformed_rate=0.0, control=None, spot=None, seed=None):
+        self.resolution = resolution
+        self.publish_hour = publish_hour
+        self.update_every = update_every
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.control = control
+        self.spot = spot
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "200": 0, "304": 0, "errors": 0, "malformed": 0}
+        self.spot_cache = (None, None) # (publication time, body)
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def publication_time(self, now):
+        '''
+        Time when the currently available prices were published.
+        '''
+        today = datetime.datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        published = today.replace(hour=self.publish_hour)
+        if now < published.timestamp():
+            published -= datetime.timedelta(days=1)
+        return int(published.timestamp())
+
+    def price(self, t):
+        # Daily shape with a morning and an evening peak plus noise
+        hour = datetime.datetime.fromtimestamp(t).hour + datetime.datetime.fromtimestamp(t).minute / 60
+        shape = 0.06 + 0.04 * math.sin((hour - 6) / 24 * 2 * math.pi) ** 2 + 0.03 * (7 <= hour < 9 or 17 <= hour < 20)
+        noise = random.Random(t).uniform(-0.02, 0.02)
+        return round(max(-0.005, shape + noise), 5)
+
+    def spot_result(self, now):
+        published = self.publication_time(now)
+        cached_published, result = self.spot_cache
+        if cached_published == published:
+            return published, result
+        start = datetime.datetime.fromtimestamp(published).replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(days=2)
+        step = self.resolution * 60
+        result = []
+        t = int(start.timestamp())
+        while t < end.timestamp():
+            price = self.price(t)
+            result.append({"Rank": 0,
+                           "DateTime": datetime.datetime.fromtimestamp(t).astimezone().isoformat(),
+                           "PriceNoTax": price,
+                           "PriceWithTax": round(price * 1.255, 5)})
+            t += step
+        for rank, i in enumerate(sorted(range(len(result)), key=lambda i: result[i]["PriceNoTax"])):
+            result[i]["Rank"] = rank + 1
+        self.spot_cache = (published, result)
+        return published, result
+
+    def control_response(self, device_mac, now):
+        '''
+        Returns (data version time, response) for the device.
+        '''
+        published, spot = self.spot_result(now)
+        updated = 0
+        version = published
+        if self.update_every:
+            updated = int(now // self.update_every) * self.update_every
+            version = max(version, updated)
+        response = optimizer.build_response(SpotPrices(spot), optimizer.FallbackSpec(), now)
+        response["metadata"] = {
+            "mac": device_mac,
+            "channels": "1",
+            "fetch_url": self.url + "/getcontrols.php",
+            "timestamp": str(int(now)),
+            "timestamp_offset": str(int(datetime.datetime.now().astimezone().utcoffset().total_seconds())),
+            "valid_until": response["metadata"]["valid_until"],
+        }
+        controls = response["controls"][0]
+        controls["name"] = ""
+        controls["updated"] = str(updated)
+        return version, response
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.count("requests")
+                delay = server.latency + server.random.uniform(0, server.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+                if server.random.random() < server.error_rate:
+                    server.count("errors")
+                    self.send_error(500)
+                    return
+                url = urlsplit(self.path)
+                now = time.time()
+                if url.path.endswith("/getcontrols.php"):
+                    query = parse_qs(url.query)
+                    if query.get("json_version", [""])[0] != "2":
+                        self.send_error(400, "Only json_version=2 is supported")
+                        return
+                    if server.control is not None:
+                        version, payload = 0, server.control
+                    else:
+                        version, payload = server.control_response(query.get("device_mac", [""])[0], now)
+                    last_request = int(query.get("last_request", ["0"])[0] or 0)
+                    self.send_payload(payload, version, last_request)
+                elif url.path.endswith("/TodayAndDayForward"):
+                    if server.spot is not None:
+                        version, payload = 0, server.spot
+                    else:
+                        version, payload = server.spot_result(now)
+                    self.send_payload(payload, version, 0)
+                else:
+                    self.send_error(404)
+
+            def send_payload(self, payload, version, last_request):
+                etag = '"' + hashlib.sha1(str(version).encode() + self.path.split("?")[0].encode()).hexdigest()[:16] + '"'
+                if version and (last_request >= version or self.headers.get("If-None-Match") == etag):
+                    server.count("304")
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                body = json.dumps(payload).encode()
+                if server.random.random() < server.malformed_rate:
+                    server.count("malformed")
+                    body = body[:len(body) // 2]
+                else:
+                    server.count("200")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if version:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def run_load(url, clients=10, duration=60, interval=5, workers=8):
+    '''
+    Poll the server with clients Porssari instances every interval seconds
+    for duration seconds using workers threads. Returns a summary dict.
+    '''
+    import porssari
+
+    instances = [porssari.Porssari(server=url + "/getcontrols.php?",
+                                   spot=url + "/TodayAndDayForward",
+                                   device_mac=f"LOAD{i:04d}", client="load")
+                 for i in range(clients)]
+    for p in instances:
+        for endpoint in (p.control_endpoint, p.spot_endpoint):
+            endpoint.backoff = 0.1
+            endpoint.attempt_log = [] # keep all attempts for the summary
+    cycle_times = []
+    end = time.monotonic() + duration
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while time.monotonic() < end:
+            start = time.monotonic()
+            list(pool.map(lambda p: p.update_task(), instances))
+            cycle_times.append(time.monotonic() - start)
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+    summary = {"clients": clients, "cycles": len(cycle_times),
+               "cycle_p50": percentile(cycle_times, 50), "cycle_max": max(cycle_times)}
+    for name in ("control", "spot"):
+        endpoints = [getattr(p, name + "_endpoint") for p in instances]
+        latencies = [attempt[1] for endpoint in endpoints for attempt in endpoint.attempt_log]
+        summary[name] = {
+            "attempts": len(latencies),
+            "hits": sum(endpoint.hits for endpoint in endpoints),
+            "misses": sum(endpoint.misses for endpoint in endpoints),
+            "errors": sum(endpoint.errors for endpoint in endpoints),
+            "retries": sum(endpoint.retries for endpoint in endpoints),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+        }
+    for p in instances:
+        p.stop()
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--resolution", type=int, default=15, help="spot price resolution in minutes")
+    parser.add_argument("--publish-hour", type=int, default=14)
+    parser.add_argument("--update-every", type=int, default=None, help="seconds between controls updated bumps")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--load", type=int, default=0, help="number of Porssari clients to run")
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--interval", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    server = StandInServer(args.host, 0 if args.load else args.port, args.resolution,
+                           args.publish_hour, args.update_every, args.latency, args.jitter,
+                           args.error_rate, args.malformed_rate).start()
+    if not args.load:
+        print("Serving", server.url)
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            server.close()
+        return
+
+    # The clients write porssari.json to the current directory and print their progress
+    workdir = tempfile.TemporaryDirectory()
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            summary = run_load(server.url, args.load, args.duration, args.interval, args.workers)
+    finally:
+        os.chdir(cwd)
+        workdir.cleanup()
+        server.close()
+    summary["server"] = server.stats
+    print(json.dumps(summary, indent=1))
+
+if __name__ == "__main__":
+    main()